@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import logging
+import os
+import time
+
+from dotenv import dotenv_values
+
+
+def parse_user_ids(user_ids: str) -> list[str]:
+    """
+    Splits a comma-separated list of user ids.
+    """
+    return [user_id.strip() for user_id in user_ids.split(',') if user_id.strip()]
+
+
+class AccessPolicy:
+    """
+    Access-control and budget tables, parsed once from the bot configuration
+    so that per-update checks are set and dict lookups.
+    """
+
+    def __init__(self, admin_user_ids: str, allowed_user_ids: str, user_budgets: str):
+        """
+        :param admin_user_ids: Comma-separated admin ids, or '-' for no admin
+        :param allowed_user_ids: Comma-separated allowed ids, or '*' to allow everyone
+        :param user_budgets: Comma-separated budgets matching allowed_user_ids, or '*' for no limits
+        """
+        self.admin_user_ids = frozenset() if admin_user_ids == '-' else frozenset(parse_user_ids(admin_user_ids))
+        self.allow_all = allowed_user_ids == '*'
+        allowed = [] if self.allow_all else parse_user_ids(allowed_user_ids)
+        self.allowed_user_ids = frozenset(allowed)
+        # users that can authorize a group chat by being a member of it
+        self.authorized_user_ids = frozenset(
+            int(user_id) for user_id in self.allowed_user_ids | self.admin_user_ids if user_id.lstrip('-').isdigit()
+        )
+
+        self.unlimited_budgets = user_budgets == '*'
+        self.default_budget = None
+        self.user_budgets: dict[str, float] = {}
+        if not self.unlimited_budgets:
+            budgets = [float(budget) for budget in user_budgets.split(',')]
+            if self.allow_all:
+                # same budget for all users, use value in first position of budget list
+                if len(budgets) > 1:
+                    logging.warning('multiple values for budgets set with unrestricted user list '
+                                    'only the first value is used as budget for everyone.')
+                self.default_budget = budgets[0]
+            else:
+                if len(budgets) < len(allowed):
+                    logging.warning(f'No budget set for user ids: {", ".join(allowed[len(budgets):])}. '
+                                    f'Budget list shorter than user list.')
+                for index, user_id in enumerate(allowed):
+                    self.user_budgets.setdefault(user_id, budgets[index] if index < len(budgets) else 0.0)
+
+    @classmethod
+    def from_config(cls, config) -> AccessPolicy:
+        return cls(config['admin_user_ids'], config['allowed_user_ids'], config['user_budgets'])
+
+    def is_admin(self, user_id) -> bool:
+        return str(user_id) in self.admin_user_ids
+
+    def is_allowed_user(self, user_id) -> bool:
+        """
+        Checks if the user is allowed by the user list (without group membership).
+        """
+        return self.allow_all or str(user_id) in self.allowed_user_ids
+
+    def get_user_budget(self, user_id) -> float | None:
+        """
+        Gets the user's budget.
+        :return: The user's budget as a float, or None if the user is not found in the allowed user list
+        """
+        # no budget restrictions for admins and '*'-budget lists
+        if self.is_admin(user_id) or self.unlimited_budgets:
+            return float('inf')
+        if self.allow_all:
+            return self.default_budget
+        return self.user_budgets.get(str(user_id))
+
+
+class AccessPolicyLoader:
+    """
+    Holds the current AccessPolicy and reloads it when the .env file changes.
+    """
+
+    def __init__(self, config: dict, env_file: str = '', reload_interval: float = 60):
+        """
+        :param config: The bot configuration, its access-control values are kept in sync on reload
+        :param env_file: Path to the .env file to watch, empty to disable hot reload
+        :param reload_interval: Minimum number of seconds between checks of the .env file
+        """
+        self.config = config
+        self.env_file = env_file
+        self.reload_interval = reload_interval
+        self.policy = AccessPolicy.from_config(config)
+        self.last_check = time.monotonic()
+        self.last_modified = self.__modified_time()
+
+    def get(self) -> AccessPolicy:
+        """
+        Gets the current access policy, reloading it if the .env file was modified.
+        """
+        if self.env_file and self.reload_interval > 0 and time.monotonic() - self.last_check >= self.reload_interval:
+            self.last_check = time.monotonic()
+            modified = self.__modified_time()
+            if modified != self.last_modified:
+                self.last_modified = modified
+                self.reload()
+        return self.policy
+
+    def reload(self):
+        """
+        Re-reads the access-control values from the .env file and rebuilds the policy.
+        """
+        values = dotenv_values(self.env_file)
+        admin_user_ids = values.get('ADMIN_USER_IDS', self.config['admin_user_ids'])
+        allowed_user_ids = values.get('ALLOWED_TELEGRAM_USER_IDS', self.config['allowed_user_ids'])
+        user_budgets = values.get('USER_BUDGETS', values.get('MONTHLY_USER_BUDGETS', self.config['user_budgets']))
+        try:
+            policy = AccessPolicy(admin_user_ids, allowed_user_ids, user_budgets)
+        except ValueError as e:
+            logging.error(f'Invalid access control values in {self.env_file}, keeping the current ones: {e}')
+            return
+        self.config['admin_user_ids'] = admin_user_ids
+        self.config['allowed_user_ids'] = allowed_user_ids
+        self.config['user_budgets'] = user_budgets
+        self.policy = policy
+        logging.info(f'Reloaded access control lists from {self.env_file}')
+
+    def __modified_time(self) -> float | None:
+        try:
+            return os.path.getmtime(self.env_file) if self.env_file else None
+        except OSError:
+            return None
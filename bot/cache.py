@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    In-memory LRU cache with optional per-entry expiry.
+    Least recently used entries are evicted once maxsize is reached.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        """
+        Initializes the cache.
+        :param maxsize: Maximum number of entries to keep
+        :param ttl: Default time to live of an entry in seconds, None for no expiry
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict = OrderedDict()  # {key: (value, expires_at)}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Gets a value from the cache and marks it as recently used.
+        :param key: The key to look up
+        :param default: Value to return if the key is missing or expired
+        :return: The cached value or default
+        """
+        entry = self.data.get(key)
+        if entry is None or self.__expired(entry):
+            if entry is not None:
+                del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl: float | None = None):
+        """
+        Stores a value in the cache, evicting the least recently used entries if needed.
+        :param key: The key to store
+        :param value: The value to store
+        :param ttl: Time to live in seconds, defaults to the cache ttl
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self.data[key] = (value, expires_at)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        """
+        Removes a value from the cache and returns it.
+        """
+        entry = self.data.pop(key, None)
+        if entry is None or self.__expired(entry):
+            return default
+        return entry[0]
+
+    def expire(self) -> int:
+        """
+        Removes all expired entries.
+        :return: The number of removed entries
+        """
+        expired = [key for key, entry in self.data.items() if self.__expired(entry)]
+        for key in expired:
+            del self.data[key]
+        return len(expired)
+
+    def __contains__(self, key) -> bool:
+        entry = self.data.get(key)
+        return entry is not None and not self.__expired(entry)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @staticmethod
+    def __expired(entry) -> bool:
+        return entry[1] is not None and entry[1] <= time.monotonic()
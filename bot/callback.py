@@ -4,7 +4,8 @@ from prompt import get_rate_dialog_prompt, transcribe
 import openai
 from kb import transcribe_dialog_kb
 import settings
-from utils import is_subscribed_decorator
+from stream_renderer import StreamRenderer
+from utils import is_subscribed_decorator, edit_message_with_retry, is_group_chat
 
 
 @is_subscribed_decorator
@@ -15,23 +16,29 @@ async def callback_rate_dialog(update: Update, context):
 
     openai.api_key = settings.OPENAI_API_KEY
     messages = [{"role": "user", "content": content}]
-    response = openai.ChatCompletion.create(
+    response = await openai.ChatCompletion.acreate(
         model='gpt-4',
         messages=messages,
         temperature=1,
         stream=True)
 
+    chat_id = message.chat_id
+
+    async def edit(text, final):
+        await edit_message_with_retry(context, chat_id, str(message.message_id), text[:4096], markdown=False)
+
+    renderer = StreamRenderer(edit, chat_id, is_group=is_group_chat(update))
     text = ''
-    for chunk in response:
+    async for chunk in response:
         chunk_text = chunk["choices"][0].get("delta").get("content")
-        if chunk_text is not None:
-            if '\n' in chunk_text:
-                text += chunk_text
-                await message.edit_text(text)
-                continue
-            text += chunk_text
-    else:
-        await message.edit_reply_markup(transcribe_dialog_kb())
+        if chunk_text is None:
+            continue
+        text += chunk_text
+        await renderer.update(text)
+
+    if text != renderer.sent_text:
+        await renderer.finish(text)
+    await message.edit_reply_markup(transcribe_dialog_kb())
 
 
 @is_subscribed_decorator
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+
+from telegram import Update
+from telegram.ext import Application
+
+# upper bound of updates python-telegram-bot may schedule at once; the actual number of updates
+# being processed is limited by ChatOrderedApplication.max_concurrent_updates
+MAX_SCHEDULED_UPDATES = 4096
+
+
+def get_serialization_key(update: object) -> int | None:
+    """
+    Gets the key updates are serialized by: the chat id, or the user id for updates
+    without a chat (inline queries and callbacks from inline messages)
+    """
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ChatOrderedApplication(Application):
+    """
+    Application that processes updates of different chats concurrently,
+    while updates of the same chat are still processed one at a time and in order.
+    """
+
+    def __init__(self, max_concurrent_updates: int, **kwargs):
+        """
+        :param max_concurrent_updates: Maximum number of updates being processed at the same time
+        """
+        super().__init__(**kwargs)
+        self.max_concurrent_updates = max_concurrent_updates
+        self.__workers: asyncio.BoundedSemaphore | None = None
+        self.__chat_locks: dict[int, tuple[asyncio.Lock, int]] = {}  # {key: (lock, number of users)}
+
+    async def process_update(self, update: object) -> None:
+        """
+        Processes the update once all earlier updates of the same chat are done
+        and a worker slot is available.
+        """
+        if self.__workers is None:
+            self.__workers = asyncio.BoundedSemaphore(self.max_concurrent_updates)
+
+        key = get_serialization_key(update)
+        if key is None:
+            async with self.__workers:
+                await super().process_update(update)
+            return
+
+        # asyncio.Lock wakes up waiters in FIFO order, and updates are scheduled in the order
+        # they were received, so the order within a chat is preserved
+        lock, users = self.__chat_locks.get(key, (asyncio.Lock(), 0))
+        self.__chat_locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                async with self.__workers:
+                    await super().process_update(update)
+        finally:
+            lock, users = self.__chat_locks[key]
+            if users == 1:
+                del self.__chat_locks[key]
+            else:
+                self.__chat_locks[key] = (lock, users - 1)
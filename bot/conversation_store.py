@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from sqlite_db import SqliteDatabase
+
+
+class Conversation:
+    """
+    Conversation history of a chat, with the token count of each message.
+    """
+
+    def __init__(self, messages: list[dict], tokens: list[int], last_updated: float | None = None, pinned: int = 1):
+        """
+        :param messages: The chat messages, starting with the system prompt
+        :param tokens: The number of tokens of each message
+        :param last_updated: Unix timestamp of the last update, defaults to now
+        :param pinned: Number of leading messages that are always sent (the system prompt and the summary)
+        """
+        self.messages = messages
+        self.tokens = tokens
+        self.token_total = sum(tokens)
+        self.last_updated = time.time() if last_updated is None else last_updated
+        self.pinned = pinned
+        self.persisted = 0  # number of leading messages already written by a persistent store
+
+
+class ConversationStore:
+    """
+    In-memory conversation store with LRU eviction once maxsize conversations are kept.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        """
+        :param maxsize: Maximum number of conversations to keep in memory
+        """
+        self.maxsize = maxsize
+        self.conversations: OrderedDict[int, Conversation] = OrderedDict()
+
+    def get(self, chat_id: int) -> Conversation | None:
+        """
+        Gets the conversation of a chat and marks it as recently used.
+        :return: The conversation, or None if the chat has none
+        """
+        conversation = self.conversations.get(chat_id)
+        if conversation is not None:
+            self.conversations.move_to_end(chat_id)
+        return conversation
+
+    async def load(self, chat_id: int) -> Conversation | None:
+        """
+        Gets the conversation of a chat like get(), but also loads it if it was evicted from memory.
+        :return: The conversation, or None if the chat has none
+        """
+        return self.get(chat_id)
+
+    def save(self, chat_id: int, conversation: Conversation):
+        """
+        Stores a new or changed conversation. A stored conversation may only be changed
+        by appending messages, other changes are saved as a new Conversation.
+        """
+        self.conversations[chat_id] = conversation
+        self.conversations.move_to_end(chat_id)
+        while len(self.conversations) > self.maxsize:
+            self.conversations.popitem(last=False)
+
+    async def flush(self):
+        """
+        Writes unsaved changes, the in-memory store has none.
+        """
+
+    def expire(self, max_age_seconds: float) -> int:
+        """
+        Removes the conversations that were not updated for max_age_seconds.
+        :return: The number of removed conversations
+        """
+        deadline = time.time() - max_age_seconds
+        expired = [chat_id for chat_id, conversation in self.conversations.items()
+                   if conversation.last_updated < deadline]
+        for chat_id in expired:
+            del self.conversations[chat_id]
+        return len(expired)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self.get(chat_id) is not None
+
+    def __len__(self) -> int:
+        return len(self.conversations)
+
+
+class SqliteConversationStore(ConversationStore):
+    """
+    Conversation store that also writes the conversations to a SQLite database (WAL mode),
+    so that histories survive restarts. Conversations evicted from memory are reloaded by load().
+    Changes are written behind by flush(), in an executor: appended messages are inserted
+    as they are, and only replaced conversations (reset, summarised or trimmed) are rewritten.
+    """
+
+    def __init__(self, db_path: str = 'conversations/conversations.db', maxsize: int = 10000):
+        """
+        :param db_path: Path to the SQLite database file
+        :param maxsize: Maximum number of conversations to keep in memory
+        """
+        super().__init__(maxsize)
+        self.flush_lock = asyncio.Lock()
+        self.dirty: dict[int, Conversation] = {}  # {chat_id: conversation}, unsaved changes
+        self.flushing: dict[int, Conversation] = {}  # {chat_id: conversation}, changes being written
+        self.expire_before: float | None = None  # unsaved expiry of stored conversations
+        # load() reads evicted conversations back while flush() may be writing others
+        self.db = SqliteDatabase(db_path, '''
+            CREATE TABLE IF NOT EXISTS conversations (
+                chat_id INTEGER PRIMARY KEY,
+                last_updated REAL NOT NULL,
+                pinned INTEGER NOT NULL DEFAULT 1
+            );
+            CREATE INDEX IF NOT EXISTS conversations_last_updated ON conversations (last_updated);
+            CREATE TABLE IF NOT EXISTS conversation_messages (
+                chat_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, position)
+            );
+        ''')
+
+    def get(self, chat_id: int) -> Conversation | None:
+        conversation = super().get(chat_id)
+        if conversation is not None:
+            return conversation
+        # evicted from memory before it was written
+        conversation = self.dirty.get(chat_id) or self.flushing.get(chat_id)
+        if conversation is not None:
+            super().save(chat_id, conversation)
+        return conversation
+
+    async def load(self, chat_id: int) -> Conversation | None:
+        conversation = self.get(chat_id)
+        if conversation is not None:
+            return conversation
+        stored = await asyncio.get_running_loop().run_in_executor(None, self.__read, chat_id)
+        # the chat may have been saved while it was read
+        conversation = self.get(chat_id)
+        if conversation is not None or stored is None:
+            return conversation
+        super().save(chat_id, stored)
+        return stored
+
+    def __read(self, chat_id: int) -> Conversation | None:
+        with self.db.reading() as connection:
+            header = connection.execute(
+                'SELECT last_updated, pinned FROM conversations WHERE chat_id = ?', (chat_id,)
+            ).fetchone()
+            rows = connection.execute(
+                'SELECT message, tokens FROM conversation_messages WHERE chat_id = ? ORDER BY position', (chat_id,)
+            ).fetchall() if header is not None else []
+        if not rows:
+            return None
+        try:
+            conversation = Conversation([json.loads(row[0]) for row in rows], [row[1] for row in rows],
+                                        header[0], header[1])
+        except ValueError as e:
+            logging.warning(f'Invalid stored conversation for chat ID {chat_id}, ignoring it: {str(e)}')
+            return None
+        conversation.persisted = len(rows)
+        return conversation
+
+    def save(self, chat_id: int, conversation: Conversation):
+        super().save(chat_id, conversation)
+        self.dirty[chat_id] = conversation
+
+    def expire(self, max_age_seconds: float) -> int:
+        expired = super().expire(max_age_seconds)
+        deadline = time.time() - max_age_seconds
+        self.dirty = {chat_id: conversation for chat_id, conversation in self.dirty.items()
+                      if conversation.last_updated >= deadline}
+        # stored conversations are removed by the next flush, so that it can't race with a write
+        self.expire_before = deadline
+        return expired
+
+    async def flush(self):
+        """
+        Writes the changed conversations and removes the expired ones from the database.
+        The changes are captured first, so later changes are left for the next flush.
+        """
+        async with self.flush_lock:
+            dirty, self.dirty = self.dirty, {}
+            expire_before, self.expire_before = self.expire_before, None
+            if not dirty and expire_before is None:
+                return
+            changes = [(chat_id, conversation.last_updated, conversation.pinned, conversation.persisted,
+                        conversation.messages[conversation.persisted:], conversation.tokens[conversation.persisted:])
+                       for chat_id, conversation in dirty.items()]
+            self.flushing = dirty
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.__write, changes, expire_before)
+            except Exception as e:
+                logging.warning(f'Failed to write conversations: {str(e)}')
+                for chat_id, conversation in dirty.items():
+                    self.dirty.setdefault(chat_id, conversation)
+                if self.expire_before is None:
+                    self.expire_before = expire_before
+                return
+            finally:
+                self.flushing = {}
+            for (chat_id, conversation), change in zip(dirty.items(), changes):
+                conversation.persisted = max(conversation.persisted, change[3] + len(change[4]))
+
+    def __write(self, changes: list[tuple], expire_before: float | None):
+        with self.db.writing() as connection:
+            if expire_before is not None:
+                # conversations written by this flush were updated after the expiry
+                written = {change[0] for change in changes}
+                expired = [row for row in connection.execute(
+                    'SELECT chat_id FROM conversations WHERE last_updated < ?', (expire_before,)
+                ) if row[0] not in written]
+                connection.executemany('DELETE FROM conversation_messages WHERE chat_id = ?', expired)
+                connection.executemany('DELETE FROM conversations WHERE chat_id = ?', expired)
+            for chat_id, last_updated, pinned, start, messages, tokens in changes:
+                # a conversation that was never written (or replaced) is rewritten from scratch
+                connection.execute('DELETE FROM conversation_messages WHERE chat_id = ? AND position >= ?',
+                                   (chat_id, start))
+                connection.executemany(
+                    'INSERT INTO conversation_messages (chat_id, position, message, tokens) VALUES (?, ?, ?, ?)',
+                    [(chat_id, start + i, json.dumps(message), message_tokens)
+                     for i, (message, message_tokens) in enumerate(zip(messages, tokens))]
+                )
+                connection.execute(
+                    'INSERT INTO conversations (chat_id, last_updated, pinned) VALUES (?, ?, ?) '
+                    'ON CONFLICT (chat_id) DO UPDATE SET '
+                    'last_updated = excluded.last_updated, pinned = excluded.pinned',
+                    (chat_id, last_updated, pinned)
+                )
+
+
+def create_conversation_store(store_type='memory', maxsize=10000,
+                              db_path='conversations/conversations.db') -> ConversationStore:
+    """
+    Creates the conversation store of the given type ('memory' or 'sqlite').
+    """
+    if store_type == 'sqlite':
+        return SqliteConversationStore(db_path, maxsize)
+    if store_type != 'memory':
+        logging.warning(f"Unknown conversation store '{store_type}', falling back to memory")
+    return ConversationStore(maxsize)
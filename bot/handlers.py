@@ -1,46 +1,45 @@
-import os
 from telegram import Update
 from telegram.ext import ContextTypes
-from utils import transcribe, chop_audio, extract_audio_from_video, streaming_transcribe, is_subscribed_decorator
-from pydub import AudioSegment
-from uuid import uuid4
+import settings
+from transcription_cache import get_transcription_cache, file_key
+from utils import stream_chop_audio, streaming_transcribe, send_transcript, is_subscribed_decorator
+
+
+async def transcribe_file(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str, file_unique_id: str):
+    """
+    транскрибирует файл из Telegram. Повторно присланные файлы отдаются из кэша транскрипций.
+    """
+    cache = get_transcription_cache()
+    if cache is not None:
+        transcript = await cache.get(file_key(file_unique_id))
+        if transcript is not None:
+            await send_transcript(update, transcript)
+            return
+
+    file = await context.bot.getFile(file_id, read_timeout=None, write_timeout=None)
+
+    # для видео ffmpeg сам вытаскивает звуковую дорожку (-vn), кадры не декодируются
+    transcript, complete = await streaming_transcribe(
+        stream_chop_audio(file.file_path, settings.TRANSCRIPTION_CHUNK_SECONDS,
+                          settings.TRANSCRIPTION_SILENCE_TOLERANCE_SECONDS),
+        update
+    )
+    # в кэш попадают только полные транскрипты, иначе ошибка Whisper закэшируется навсегда
+    if cache is not None and complete and transcript.strip():
+        await cache.set(file_key(file_unique_id), transcript)
 
 
 @is_subscribed_decorator
 async def audio_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_message.reply_text('запрос отправлен')
-    audio = update.message.audio
-    if audio:
-        file_id = update.message.audio.file_id
-    else:
-        file_id = update.message.voice.file_id
+    audio = update.message.audio or update.message.voice
 
-    file = await context.bot.getFile(file_id, read_timeout=None, write_timeout=None)
-
-    audio = AudioSegment.from_file(file.file_path)
-
-    await streaming_transcribe(audio, update)
+    await transcribe_file(update, context, audio.file_id, audio.file_unique_id)
 
 
 @is_subscribed_decorator
 async def video_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_message.reply_text('запрос отправлен')
+    video = update.message.video_note or update.message.video
 
-    video_note = update.message.video_note
-    if video_note:
-        file_id = video_note.file_id
-    else:
-        file_id = update.message.video.file_id
-
-    file = await context.bot.getFile(file_id, read_timeout=None, write_timeout=None)
-
-    audio = extract_audio_from_video(file.file_path)
-
-    audio_name = f'/app/bot/file/{uuid4()}.mp3'
-    audio.write_audiofile(audio_name)
-
-    audio = AudioSegment.from_file(audio_name)
-    os.remove(audio_name)
-
-    await streaming_transcribe(audio, update)
-
+    await transcribe_file(update, context, video.file_id, video.file_unique_id)
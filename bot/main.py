@@ -1,10 +1,13 @@
 import logging
 import os
 
-from dotenv import load_dotenv
+from dotenv import load_dotenv, find_dotenv
 
+from access_policy import AccessPolicyLoader
+from conversation_store import create_conversation_store
 from openai_helper import OpenAIHelper, default_max_tokens
 from telegram_bot import ChatGPTTelegramBot
+from usage_store import create_usage_store
 
 
 def main():
@@ -44,7 +47,19 @@ def main():
         'presence_penalty': float(os.environ.get('PRESENCE_PENALTY', 0.0)),
         'frequency_penalty': float(os.environ.get('FREQUENCY_PENALTY', 0.0)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
+        'summary_model': os.environ.get('SUMMARY_MODEL', 'gpt-3.5-turbo'),
+        'summary_threshold': float(os.environ.get('SUMMARY_THRESHOLD', 0.8)),
+        'response_cache_size': int(os.environ.get('RESPONSE_CACHE_SIZE', 1000)),
+        'response_cache_ttl': int(os.environ.get('RESPONSE_CACHE_TTL', 3600)),
+        'response_cache_max_temperature': float(os.environ.get('RESPONSE_CACHE_MAX_TEMPERATURE', 0.3)),
+        'requests_per_minute': int(os.environ.get('OPENAI_RPM_LIMIT', 0)),
+        'tokens_per_minute': int(os.environ.get('OPENAI_TPM_LIMIT', 0)),
     }
+    openai_config['conversation_store'] = create_conversation_store(
+        os.environ.get('CONVERSATION_STORE', 'memory').lower(),
+        maxsize=int(os.environ.get('MAX_CONVERSATIONS', 10000)),
+        db_path=os.environ.get('CONVERSATION_DB_PATH', 'conversations/conversations.db')
+    )
 
     # log deprecation warning for old budget variable names
     # old variables are caught in the telegram_config definition for now
@@ -76,7 +91,22 @@ def main():
         'image_prices': [float(i) for i in os.environ.get('IMAGE_PRICES', "0.016,0.018,0.02").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
+        'concurrent_updates': int(os.environ.get('CONCURRENT_UPDATES', 32)),
+        'group_members_cache_ttl': int(os.environ.get('GROUP_MEMBERS_CACHE_TTL', 600)),
+        'usage_flush_interval': float(os.environ.get('USAGE_FLUSH_INTERVAL_SECONDS', 10)),
+        'conversation_flush_interval': float(os.environ.get('CONVERSATION_FLUSH_INTERVAL_SECONDS', 5)),
+        'usage_cache_size': int(os.environ.get('USAGE_CACHE_SIZE', 1000)),
+        'usage_cache_idle_seconds': int(os.environ.get('USAGE_CACHE_IDLE_SECONDS', 3600)),
     }
+    telegram_config['access_policy'] = AccessPolicyLoader(
+        telegram_config,
+        env_file=find_dotenv(),
+        reload_interval=float(os.environ.get('ACCESS_POLICY_RELOAD_INTERVAL', 60))
+    )
+    telegram_config['usage_store'] = create_usage_store(
+        os.environ.get('USAGE_STORE', 'json').lower(),
+        db_path=os.environ.get('USAGE_DB_PATH', 'usage_logs/usage.db')
+    )
 
     # Setup and run ChatGPT and Telegram bot
     openai_helper = OpenAIHelper(config=openai_config)
@@ -1,18 +1,24 @@
 from __future__ import annotations
-import datetime
+import asyncio
+import functools
+import json
 import logging
 import os
+import time
 
 import tiktoken
 
 import openai
 
-import requests
-import json
 from datetime import date
 from calendar import monthrange
 
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+from cache import TTLCache
+from conversation_store import Conversation, ConversationStore
+from rate_limiter import RateLimitScheduler
+from response_cache import CachedStream, ResponseCache
+from stream_broadcast import StreamBroadcast
+from utils import get_http_client
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 GPT_3_MODELS = ("gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613")
@@ -21,6 +27,18 @@ GPT_4_MODELS = ("gpt-4", "gpt-4-0314", "gpt-4-0613")
 GPT_4_32K_MODELS = ("gpt-4-32k", "gpt-4-32k-0314", "gpt-4-32k-0613")
 GPT_ALL_MODELS = GPT_3_MODELS + GPT_3_16K_MODELS + GPT_4_MODELS + GPT_4_32K_MODELS
 
+# seconds the billed usage of the current month is cached for
+BILLING_CACHE_TTL = 300
+# seconds to wait for the billing API before giving up
+BILLING_TIMEOUT = 10
+# attempts of a chat completion request that hits the rate limit
+MAX_RATE_LIMITED_ATTEMPTS = 3
+# tokens reserved for a summary in the rate limit budget (700 characters)
+SUMMARY_MAX_TOKENS = 250
+# seconds to wait before summarising a chat again after a failed summary
+SUMMARY_RETRY_DELAY = 300
+SUMMARY_INSTRUCTION = {"role": "assistant", "content": "Summarize this conversation in 700 characters or less"}
+
 
 def default_max_tokens(model: str) -> int:
     """
@@ -39,6 +57,19 @@ def default_max_tokens(model: str) -> int:
         return base * 8
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Gets the tiktoken encoding for the given model, resolved once per model.
+    :param model: The model name
+    :return: The encoding used by the model
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 # Load translations
 parent_dir_path = os.path.join(os.path.dirname(__file__), os.pardir)
 translations_file_path = os.path.join(parent_dir_path, 'translations.json')
@@ -77,18 +108,26 @@ class OpenAIHelper:
         openai.api_key = config['api_key']
         openai.proxy = config['proxy']
         self.config = config
-        self.conversations: dict[int: list] = {}  # {chat_id: history}
-        self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
-
-    def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
+        self.conversations: ConversationStore = config.get('conversation_store')
+        if self.conversations is None:
+            self.conversations = ConversationStore()
+        self.billing_cache = TTLCache(maxsize=2, ttl=BILLING_CACHE_TTL)  # {year-month: dollars}
+        self.billing_requests: dict[str, asyncio.Task] = {}  # {year-month: Task}, lookups in progress
+        self.summary_tasks: dict[int, asyncio.Task] = {}  # {chat_id: Task}, background summaries in progress
+        self.summary_retry_at: dict[int, float] = {}  # {chat_id: monotonic time}, backoff after failed summaries
+        self.inflight_requests: dict[str, asyncio.Task] = {}  # {request fingerprint: Task}
+        self.rate_limits = RateLimitScheduler(config.get('requests_per_minute', 0), config.get('tokens_per_minute', 0))
+        self.response_cache = ResponseCache(config['response_cache_size'], config['response_cache_ttl']) \
+            if config.get('response_cache_size', 0) > 0 else None
+
+    async def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
         Gets the number of messages and tokens used in the conversation.
         :param chat_id: The chat ID
         :return: A tuple containing the number of messages and tokens used
         """
-        if chat_id not in self.conversations:
-            self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        await self.conversations.load(chat_id)
+        return len(self.__get_conversation(chat_id).messages), self.__count_conversation_tokens(chat_id)
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
@@ -97,7 +136,7 @@ class OpenAIHelper:
         :param query: The query to send to the model
         :return: The answer from the model and the number of tokens used
         """
-        response = await self.__common_get_chat_response(chat_id, query)
+        response, cache_key = await self.__common_get_chat_response(chat_id, query)
         answer = ''
 
         if len(response.choices) > 1 and self.config['n_choices'] > 1:
@@ -111,6 +150,8 @@ class OpenAIHelper:
         else:
             answer = response.choices[0]['message']['content'].strip()
             self.__add_to_history(chat_id, role="assistant", content=answer)
+            if cache_key is not None:
+                self.response_cache.set(cache_key, answer, response.usage['total_tokens'])
 
         bot_language = self.config['bot_language']
         if self.config['show_usage']:
@@ -119,6 +160,7 @@ class OpenAIHelper:
                       f" ({str(response.usage['prompt_tokens'])} {localized_text('prompt', bot_language)}," \
                       f" {str(response.usage['completion_tokens'])} {localized_text('completion', bot_language)})"
 
+        self.__schedule_summary(chat_id)
         return answer, response.usage['total_tokens']
 
     async def get_chat_response_stream(self, chat_id: int, query: str):
@@ -128,7 +170,7 @@ class OpenAIHelper:
         :param query: The query to send to the model
         :return: The answer from the model and the number of tokens used, or 'not_finished'
         """
-        response = await self.__common_get_chat_response(chat_id, query, stream=True)
+        response, cache_key = await self.__common_get_chat_response(chat_id, query, stream=True)
 
         answer = ''
         async for item in response:
@@ -140,62 +182,77 @@ class OpenAIHelper:
                 yield answer, 'not_finished'
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        if isinstance(response, CachedStream):
+            # replayed from the response cache, no tokens were used
+            tokens_used = '0'
+        else:
+            tokens_used = str(self.__count_context_tokens(chat_id))
+            if cache_key is not None:
+                self.response_cache.set(cache_key, answer, int(tokens_used))
+        self.__schedule_summary(chat_id)
 
         if self.config['show_usage']:
             answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
 
         yield answer, tokens_used
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.error.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3)
-    )
     async def __common_get_chat_response(self, chat_id: int, query: str, stream=False):
         """
-        Request a response from the GPT model.
+        Request a response from the GPT model, or replay it from the response cache.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used
+        :return: The response, and the key to cache its answer under (None if it must not be cached)
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
+            if await self.conversations.load(chat_id) is None or self.__max_age_reached(chat_id):
                 self.reset_chat_history(chat_id)
 
-            self.last_updated[chat_id] = datetime.datetime.now()
-
             self.__add_to_history(chat_id, role="user", content=query)
-
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
-
-            return await openai.ChatCompletion.acreate(
-                model=self.config['model'],
-                messages=self.conversations[chat_id],
-                temperature=self.config['temperature'],
-                n=self.config['n_choices'],
-                max_tokens=self.config['max_tokens'],
-                presence_penalty=self.config['presence_penalty'],
-                frequency_penalty=self.config['frequency_penalty'],
-                stream=stream
-            )
+            conversation = self.__get_conversation(chat_id)
+
+            # Histories are summarised in the background once they pass the soft limit (see __schedule_summary),
+            # and only the newest messages that fit the model's context window are sent (see __build_context).
+            # If the history size limit is reached anyway, wait for a summary already in progress, then trim.
+            if len(conversation.messages) > self.config['max_history_size']:
+                summary_task = self.summary_tasks.get(chat_id)
+                if summary_task is not None:
+                    await asyncio.shield(summary_task)
+                if len(self.__get_conversation(chat_id).messages) > self.config['max_history_size']:
+                    logging.info(f'Chat history for chat ID {chat_id} is too long. Popping elements...')
+                    self.__trim_history(chat_id, self.config['max_history_size'])
+
+            messages = self.__build_context(self.__get_conversation(chat_id))
+            params = {
+                'temperature': self.config['temperature'],
+                'n': self.config['n_choices'],
+                'max_tokens': self.config['max_tokens'],
+                'presence_penalty': self.config['presence_penalty'],
+                'frequency_penalty': self.config['frequency_penalty'],
+            }
+
+            cache_key = None
+            if self.__response_cacheable():
+                cache_key = ResponseCache.key(self.config['model'], params, messages)
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    logging.info(f'Response cache hit for chat ID {chat_id} (hit rate '
+                                 f'{self.response_cache.hit_rate:.0%}, {self.response_cache.saved_tokens} tokens saved)')
+                    return (cached.as_stream() if stream else cached.as_completion()), None
+
+            # identical requests in flight share one upstream call
+            fingerprint = f"{'stream' if stream else 'full'}:" \
+                          f"{cache_key or ResponseCache.key(self.config['model'], params, messages)}"
+            request = self.inflight_requests.get(fingerprint)
+            if request is None:
+                prompt_tokens = self.__count_context_tokens(chat_id)
+                request = asyncio.create_task(self.__request_completion(messages, params, stream, prompt_tokens))
+                self.inflight_requests[fingerprint] = request
+                request.add_done_callback(functools.partial(self.__request_done, fingerprint))
+            else:
+                logging.info(f'Joining an identical request in flight for chat ID {chat_id}')
+            response = await asyncio.shield(request)
+            return (response.subscribe() if stream else response), cache_key
 
         except openai.error.RateLimitError as e:
             raise e
@@ -249,7 +306,34 @@ class OpenAIHelper:
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "system", "content": content}]
+        message = {"role": "system", "content": content}
+        self.conversations.save(chat_id, Conversation([message], [self.__count_message_tokens(message)]))
+        self.summary_retry_at.pop(chat_id, None)
+
+    def expire_conversations(self) -> int:
+        """
+        Removes the conversations that reached the maximum conversation age.
+        :return: The number of removed conversations
+        """
+        return self.conversations.expire(self.config['max_conversation_age_minutes'] * 60)
+
+    async def flush_conversations(self):
+        """
+        Writes the unsaved conversation changes of a persistent conversation store.
+        """
+        await self.conversations.flush()
+
+    def __get_conversation(self, chat_id) -> Conversation:
+        """
+        Gets the conversation of a chat, starting a new one if it has none (or it was evicted).
+        :param chat_id: The chat ID
+        :return: The conversation
+        """
+        conversation = self.conversations.get(chat_id)
+        if conversation is None:
+            self.reset_chat_history(chat_id)
+            conversation = self.conversations.get(chat_id)
+        return conversation
 
     def __max_age_reached(self, chat_id) -> bool:
         """
@@ -257,12 +341,11 @@ class OpenAIHelper:
         :param chat_id: The chat ID
         :return: A boolean indicating whether the maximum conversation age has been reached
         """
-        if chat_id not in self.last_updated:
+        conversation = self.conversations.get(chat_id)
+        if conversation is None:
             return False
-        last_updated = self.last_updated[chat_id]
-        now = datetime.datetime.now()
         max_age_minutes = self.config['max_conversation_age_minutes']
-        return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
+        return conversation.last_updated < time.time() - max_age_minutes * 60
 
     def __add_to_history(self, chat_id, role, content):
         """
@@ -271,51 +354,255 @@ class OpenAIHelper:
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        message = {"role": role, "content": content}
+        tokens = self.__count_message_tokens(message)
+        conversation = self.__get_conversation(chat_id)
+        conversation.messages.append(message)
+        conversation.tokens.append(tokens)
+        conversation.token_total += tokens
+        conversation.last_updated = time.time()
+        self.conversations.save(chat_id, conversation)
+
+    def __trim_history(self, chat_id, max_size):
+        """
+        Keeps only the last max_size messages of the conversation history,
+        plus the system prompt and the summary.
+        :param chat_id: The chat ID
+        :param max_size: The number of messages to keep
+        """
+        conversation = self.__get_conversation(chat_id)
+        pinned = conversation.pinned
+        keep = max(max_size - pinned, 1)
+        self.conversations.save(chat_id, Conversation(
+            conversation.messages[:pinned] + conversation.messages[pinned:][-keep:],
+            conversation.tokens[:pinned] + conversation.tokens[pinned:][-keep:],
+            conversation.last_updated,
+            pinned
+        ))
+
+    def __build_context(self, conversation: Conversation) -> list[dict]:
+        """
+        Selects the messages to send: the system prompt and the summary are always sent,
+        followed by as many of the newest messages as fit the model's context window
+        after reserving max_tokens for the reply. The newest message is always sent.
+        :param conversation: The conversation
+        :return: The messages to send
+        """
+        pinned = conversation.pinned
+        # every reply is primed with <|start|>assistant<|message|>
+        budget = self.__max_model_tokens() - self.config['max_tokens'] - 3
+        budget -= sum(conversation.tokens[:pinned])
+
+        start = len(conversation.messages)
+        while start > pinned:
+            tokens = conversation.tokens[start - 1]
+            if tokens > budget and start < len(conversation.messages):
+                break
+            budget -= tokens
+            start -= 1
+        if start > pinned:
+            logging.debug(f'Sending the last {len(conversation.messages) - start} of '
+                          f'{len(conversation.messages) - pinned} messages to fit the context window')
+        return conversation.messages[:pinned] + conversation.messages[start:]
+
+    def __count_context_tokens(self, chat_id) -> int:
+        """
+        Gets the number of tokens __build_context would send for the conversation.
+        :param chat_id: The chat ID
+        :return: the number of tokens
+        """
+        conversation = self.__get_conversation(chat_id)
+        context_size = len(self.__build_context(conversation)) - conversation.pinned
+        context_tokens = conversation.tokens[:conversation.pinned]
+        if context_size > 0:
+            context_tokens = context_tokens + conversation.tokens[-context_size:]
+        return sum(context_tokens) + 3  # every reply is primed with <|start|>assistant<|message|>
+
+    async def __request_completion(self, messages, params, stream, prompt_tokens):
+        """
+        Sends a chat completion request once the model's rate limits allow it.
+        :param prompt_tokens: The estimated number of prompt tokens
+        :return: The response, or a StreamBroadcast of it for streamed requests
+        """
+        response = await self.__rate_limited(
+            self.config['model'],
+            prompt_tokens + params['max_tokens'] * params['n'],
+            lambda: openai.ChatCompletion.acreate(
+                model=self.config['model'],
+                messages=messages,
+                stream=stream,
+                **params
+            )
+        )
+        return StreamBroadcast(response) if stream else response
+
+    async def __rate_limited(self, model, tokens, request):
+        """
+        Waits for the model's request and token budgets before sending the request, and retries it
+        after the reset time given by the API if the rate limit is hit anyway.
+        :param model: The model the request is sent to
+        :param tokens: The estimated number of tokens the request uses (prompt and completion)
+        :param request: Function starting the request
+        :return: The response
+        """
+        limiter = self.rate_limits.get(model)
+        for attempt in range(MAX_RATE_LIMITED_ATTEMPTS):
+            await limiter.acquire(tokens)
+            try:
+                return await request()
+            except openai.error.RateLimitError as e:
+                limiter.on_rate_limit(e.headers)
+                if attempt == MAX_RATE_LIMITED_ATTEMPTS - 1:
+                    raise
+
+    def __request_done(self, fingerprint, request: asyncio.Task):
+        """
+        Stops sharing a finished request. Streamed requests are shared until the stream ends.
+        """
+        def remove(_=None):
+            if self.inflight_requests.get(fingerprint) is request:
+                del self.inflight_requests[fingerprint]
+
+        if request.cancelled() or request.exception() is not None:
+            remove()
+        elif isinstance(request.result(), StreamBroadcast):
+            request.result().task.add_done_callback(remove)
+        else:
+            remove()
 
-    async def __summarise(self, conversation) -> str:
+    def __response_cacheable(self) -> bool:
+        """
+        Checks if answers may be reused: the response cache is enabled, a single answer is requested
+        and the temperature is low enough for answers to identical requests to be interchangeable.
+        """
+        return self.response_cache is not None and self.config['n_choices'] == 1 \
+            and self.config['temperature'] <= self.config['response_cache_max_temperature']
+
+    def __history_too_long(self, conversation: Conversation, threshold: float) -> bool:
+        """
+        Checks if the conversation exceeds the given fraction of the history size or token limit.
+        :param conversation: The conversation
+        :param threshold: Fraction of the limits
+        :return: A boolean indicating whether the conversation is too long
+        """
+        max_prompt_tokens = self.__max_model_tokens() - self.config['max_tokens']
+        exceeded_max_tokens = conversation.token_total + 3 > max_prompt_tokens * threshold
+        exceeded_max_history_size = len(conversation.messages) > self.config['max_history_size'] * threshold
+        return exceeded_max_tokens or exceeded_max_history_size
+
+    def __schedule_summary(self, chat_id):
+        """
+        Starts summarising the conversation in the background if it passed the soft limit.
+        :param chat_id: The chat ID
+        """
+        conversation = self.conversations.get(chat_id)
+        if conversation is None or chat_id in self.summary_tasks:
+            return
+        if time.monotonic() < self.summary_retry_at.get(chat_id, 0):
+            return
+        if not self.__history_too_long(conversation, self.config['summary_threshold']):
+            return
+        model = self.__summary_model()
+        # summarise everything but the system prompt and the last user/assistant exchange,
+        # as far as it fits into the context window of the summary model
+        budget = self.__max_model_tokens(model) - SUMMARY_MAX_TOKENS \
+            - self.__count_message_tokens(SUMMARY_INSTRUCTION) - 8  # the user message and reply priming
+        summarised = 1
+        while summarised < len(conversation.messages) - 2 and conversation.tokens[summarised] <= budget:
+            budget -= conversation.tokens[summarised]
+            summarised += 1
+        if summarised <= 1:
+            return
+        task = asyncio.create_task(self.__summarise_history(chat_id, conversation, summarised, model))
+        self.summary_tasks[chat_id] = task
+        task.add_done_callback(lambda _: self.summary_tasks.pop(chat_id, None))
+
+    async def __summarise_history(self, chat_id, conversation: Conversation, summarised: int, model: str):
+        """
+        Replaces the older part of the conversation with a summary.
+        Messages added while the summary was being generated are kept as is.
+        :param chat_id: The chat ID
+        :param conversation: The conversation to summarise
+        :param summarised: The number of leading messages (including the system prompt) to replace
+        :param model: The model to summarise with
+        """
+        logging.info(f'Chat history for chat ID {chat_id} is getting long. Summarising in the background...')
+        try:
+            summary = await self.__summarise(conversation.messages[1:summarised],
+                                             sum(conversation.tokens[1:summarised]), model)
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history, retrying in {SUMMARY_RETRY_DELAY}s: {str(e)}')
+            self.summary_retry_at[chat_id] = time.monotonic() + SUMMARY_RETRY_DELAY
+            return
+        self.summary_retry_at.pop(chat_id, None)
+        logging.debug(f'Summary: {summary}')
+
+        # only swap the history in if the conversation was not reset or trimmed in the meantime
+        if self.conversations.get(chat_id) is not conversation or len(conversation.messages) < summarised:
+            return
+        summary_message = {"role": "assistant", "content": summary}
+        compacted = Conversation(
+            [conversation.messages[0], summary_message] + conversation.messages[summarised:],
+            [conversation.tokens[0], self.__count_message_tokens(summary_message)] + conversation.tokens[summarised:],
+            conversation.last_updated,
+            pinned=2
+        )
+        self.conversations.save(chat_id, compacted)
+
+    async def __summarise(self, conversation, prompt_tokens, model) -> str:
         """
         Summarises the conversation history.
         :param conversation: The conversation history
+        :param prompt_tokens: The number of tokens of the conversation history
+        :param model: The model to summarise with
         :return: The summary
         """
-        messages = [
-            {"role": "assistant", "content": "Summarize this conversation in 700 characters or less"},
-            {"role": "user", "content": str(conversation)}
-        ]
-        response = await openai.ChatCompletion.acreate(
-            model=self.config['model'],
-            messages=messages,
-            temperature=0.4
+        # one "role: content" line per message, which takes no more tokens than the messages themselves
+        transcript = '\n'.join(f"{message['role']}: {message['content']}" for message in conversation)
+        messages = [SUMMARY_INSTRUCTION, {"role": "user", "content": transcript}]
+        response = await self.__rate_limited(
+            model,
+            prompt_tokens + SUMMARY_MAX_TOKENS,
+            lambda: openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                temperature=0.4
+            )
         )
         return response.choices[0]['message']['content']
 
-    def __max_model_tokens(self):
+    def __summary_model(self) -> str:
+        """
+        Gets the model to summarise with: the configured summary model,
+        or the chat model if the context size of the summary model is not known.
+        """
+        model = self.config['summary_model']
+        return model if model in GPT_ALL_MODELS else self.config['model']
+
+    def __max_model_tokens(self, model=None):
+        model = model or self.config['model']
         base = 4096
-        if self.config['model'] in GPT_3_MODELS:
+        if model in GPT_3_MODELS:
             return base
-        if self.config['model'] in GPT_3_16K_MODELS:
+        if model in GPT_3_16K_MODELS:
             return base * 4
-        if self.config['model'] in GPT_4_MODELS:
+        if model in GPT_4_MODELS:
             return base * 2
-        if self.config['model'] in GPT_4_32K_MODELS:
+        if model in GPT_4_32K_MODELS:
             return base * 8
         raise NotImplementedError(
-            f"Max tokens for model {self.config['model']} is not implemented yet."
+            f"Max tokens for model {model} is not implemented yet."
         )
 
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    def __count_message_tokens(self, message) -> int:
         """
-        Counts the number of tokens required to send the given messages.
-        :param messages: the messages to send
-        :return: the number of tokens required
+        Counts the number of tokens a single message takes up in a request.
+        :param message: the message to count
+        :return: the number of tokens required for the message
         """
         model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("gpt-3.5-turbo")
+        encoding = get_encoding(model)
 
         if model in GPT_3_MODELS + GPT_3_16K_MODELS:
             tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
@@ -325,21 +612,41 @@ class OpenAIHelper:
             tokens_per_name = 1
         else:
             raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":
-                    num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += tokens_per_name
         return num_tokens
 
-    def get_billing_current_month(self):
+    def __count_conversation_tokens(self, chat_id) -> int:
+        """
+        Gets the number of tokens required to send the conversation history,
+        using the per-message counts kept alongside the history.
+        :param chat_id: The chat ID
+        :return: the number of tokens required
+        """
+        return self.__get_conversation(chat_id).token_total + 3  # every reply is primed with <|start|>assistant<|message|>
+
+    async def get_billing_current_month(self) -> float:
         """Gets billed usage for current month from OpenAI API.
+        The result is cached for BILLING_CACHE_TTL seconds and concurrent lookups share one request.
 
         :return: dollar amount of usage this month
         """
+        month = date.today().strftime('%Y-%m')
+        cached = self.billing_cache.get(month)
+        if cached is not None:
+            return cached
+
+        task = self.billing_requests.get(month)
+        if task is None:
+            task = asyncio.create_task(self.__fetch_billing(month))
+            self.billing_requests[month] = task
+            task.add_done_callback(lambda _: self.billing_requests.pop(month, None))
+        return await asyncio.shield(task)
+
+    async def __fetch_billing(self, month: str) -> float:
         headers = {
             "Authorization": f"Bearer {openai.api_key}"
         }
@@ -349,10 +656,12 @@ class OpenAIHelper:
         _, last_day_of_month = monthrange(today.year, today.month)
         last_day = date(today.year, today.month, last_day_of_month)
         params = {
-            "start_date": first_day,
-            "end_date": last_day
+            "start_date": str(first_day),
+            "end_date": str(last_day)
         }
-        response = requests.get("https://api.openai.com/dashboard/billing/usage", headers=headers, params=params)
-        billing_data = json.loads(response.text)
-        usage_month = billing_data["total_usage"] / 100  # convert cent amount to dollars
+        response = await get_http_client().get("https://api.openai.com/dashboard/billing/usage",
+                                               headers=headers, params=params, timeout=BILLING_TIMEOUT)
+        response.raise_for_status()
+        usage_month = response.json()["total_usage"] / 100  # convert cent amount to dollars
+        self.billing_cache.set(month, usage_month)
         return usage_month
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+
+from token_bucket import TokenBucket, acquire_all
+
+# seconds to wait after a rate limit error without a Retry-After or reset header
+DEFAULT_RATE_LIMIT_DELAY = 5
+
+
+def parse_duration(value) -> float | None:
+    """
+    Parses a duration like '20ms', '1s' or '6m0.5s' (as used by the x-ratelimit-reset-* headers),
+    or a plain number of seconds (as used by Retry-After).
+    :return: The duration in seconds, or None if it can't be parsed
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value:
+        return None
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def parse_int(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ModelRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets of one model. Requests wait in FIFO order
+    until both budgets allow them. Limits can be configured, and are learned from the
+    x-ratelimit-limit-* headers of rate limit errors otherwise.
+    """
+
+    def __init__(self, model: str, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        """
+        :param model: The model name, used for logging
+        :param requests_per_minute: Request limit, 0 if unknown
+        :param tokens_per_minute: Token limit, 0 if unknown
+        """
+        self.model = model
+        self.requests = self.__bucket(requests_per_minute)
+        self.tokens = self.__bucket(tokens_per_minute)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        """
+        Waits until a request using the given number of tokens (prompt and completion) may be sent.
+        """
+        async with self.lock:
+            await acquire_all((self.requests, 1), (self.tokens, tokens))
+
+    def on_rate_limit(self, headers):
+        """
+        Adapts the budgets to a rate limit error: learns the limits and pauses until the reset time.
+        :param headers: The HTTP headers of the error response
+        """
+        headers = {str(key).lower(): value for key, value in (headers or {}).items()}
+        requests_limit = parse_int(headers.get('x-ratelimit-limit-requests'))
+        if requests_limit and requests_limit != self.requests.capacity:
+            self.requests = self.__bucket(requests_limit, self.requests)
+        tokens_limit = parse_int(headers.get('x-ratelimit-limit-tokens'))
+        if tokens_limit and tokens_limit != self.tokens.capacity:
+            self.tokens = self.__bucket(tokens_limit, self.tokens)
+
+        retry_after = parse_duration(headers.get('retry-after'))
+        requests_reset = parse_duration(headers.get('x-ratelimit-reset-requests'))
+        tokens_reset = parse_duration(headers.get('x-ratelimit-reset-tokens'))
+        if parse_int(headers.get('x-ratelimit-remaining-requests')) == 0 and requests_reset:
+            self.requests.block(requests_reset)
+        if parse_int(headers.get('x-ratelimit-remaining-tokens')) == 0 and tokens_reset:
+            self.tokens.block(tokens_reset)
+        if retry_after is not None or (requests_reset is None and tokens_reset is None):
+            delay = retry_after if retry_after is not None else DEFAULT_RATE_LIMIT_DELAY
+            self.requests.block(delay)
+            self.tokens.block(delay)
+        logging.warning(f'Rate limit reached for {self.model}, waiting for '
+                        f'{max(self.requests.delay(), self.tokens.delay()):.1f}s')
+
+    @staticmethod
+    def __bucket(per_minute: int, previous: TokenBucket | None = None) -> TokenBucket:
+        if per_minute <= 0:
+            return TokenBucket(rate=float('inf'), capacity=float('inf'))
+        bucket = TokenBucket(rate=per_minute / 60, capacity=per_minute)
+        if previous is not None:
+            bucket.blocked_until = previous.blocked_until
+        return bucket
+
+
+class RateLimitScheduler:
+    """
+    Holds the rate limiters of all models.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        """
+        :param requests_per_minute: Initial request limit of each model, 0 to learn it from rate limit errors
+        :param tokens_per_minute: Initial token limit of each model, 0 to learn it from rate limit errors
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.limiters: dict[str, ModelRateLimiter] = {}
+
+    def get(self, model: str) -> ModelRateLimiter:
+        if model not in self.limiters:
+            self.limiters[model] = ModelRateLimiter(model, self.requests_per_minute, self.tokens_per_minute)
+        return self.limiters[model]
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+
+from openai.openai_object import OpenAIObject
+
+from cache import TTLCache
+
+
+class CachedResponse:
+    """
+    A cached chat completion answer, replayed like a response from the API.
+    """
+
+    def __init__(self, content: str, total_tokens: int):
+        """
+        :param content: The answer
+        :param total_tokens: The number of tokens the original request used
+        """
+        self.content = content
+        self.total_tokens = total_tokens
+
+    def as_completion(self) -> OpenAIObject:
+        """
+        Gets the answer as a non-streamed completion. No tokens were used for it.
+        """
+        return OpenAIObject.construct_from({
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.content}}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+    def as_stream(self) -> CachedStream:
+        """
+        Gets the answer as a streamed completion.
+        """
+        return CachedStream(self.content)
+
+
+class CachedStream:
+    """
+    Replays a cached answer as streamed completion chunks, one word at a time.
+    """
+
+    def __init__(self, content: str):
+        self.content = content
+
+    async def __aiter__(self):
+        for word in re.findall(r'\s*\S+\s*', self.content):
+            yield OpenAIObject.construct_from({'choices': [{'index': 0, 'delta': {'content': word}}]})
+
+
+class ResponseCache:
+    """
+    Exact-match cache of chat completion answers, keyed by the model, the sampling parameters
+    and the messages sent. Entries expire after ttl seconds and least recently used entries
+    are evicted once maxsize answers are cached.
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 3600):
+        """
+        :param maxsize: Maximum number of cached answers
+        :param ttl: Number of seconds an answer is reused for
+        """
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.saved_tokens = 0
+
+    @staticmethod
+    def key(model: str, params: dict, messages: list[dict]) -> str:
+        """
+        Computes the cache key of a request. Surrounding whitespace in messages is ignored.
+        """
+        normalized = [{**message, 'content': message['content'].strip()} for message in messages]
+        data = json.dumps({'model': model, 'params': params, 'messages': normalized}, sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> CachedResponse | None:
+        """
+        Gets a cached answer and counts the tokens saved by reusing it.
+        """
+        response = self.cache.get(key)
+        if response is not None:
+            self.saved_tokens += response.total_tokens
+        return response
+
+    def set(self, key: str, content: str, total_tokens: int):
+        """
+        Caches an answer.
+        :param key: The cache key of the request
+        :param content: The answer
+        :param total_tokens: The number of tokens the request used
+        """
+        self.cache.set(key, CachedResponse(content, total_tokens))
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.cache.hits + self.cache.misses
+        return self.cache.hits / lookups if lookups else 0.0
@@ -6,6 +6,31 @@ load_dotenv()
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 TELEGRAM_KEY = os.environ.get('TELEGRAM_TOKEN')
 
-CHANNELS = os.environ.get('CHANNELS', [])
-    # '@BogdanAndMikhael',
+# каналы через запятую, например '@BogdanAndMikhael'
+CHANNELS = [channel.strip() for channel in os.environ.get('CHANNELS', '').split(',') if channel.strip()]
+# кэш проверок подписки: сколько секунд помнить подписчиков и неподписчиков
+SUBSCRIPTION_CACHE_TTL = float(os.environ.get('SUBSCRIPTION_CACHE_TTL', 600))
+SUBSCRIPTION_NEGATIVE_CACHE_TTL = float(os.environ.get('SUBSCRIPTION_NEGATIVE_CACHE_TTL', 30))
+SUBSCRIPTION_CACHE_SIZE = int(os.environ.get('SUBSCRIPTION_CACHE_SIZE', 100000))
 
+# сколько кусков одной записи транскрибируются одновременно
+TRANSCRIPTION_CONCURRENCY = int(os.environ.get('TRANSCRIPTION_CONCURRENCY', 4))
+# общий лимит одновременных запросов к Whisper на весь бот (rate limit аккаунта)
+WHISPER_MAX_CONCURRENT_REQUESTS = int(os.environ.get('WHISPER_MAX_CONCURRENT_REQUESTS', 8))
+WHISPER_MAX_RETRIES = int(os.environ.get('WHISPER_MAX_RETRIES', 3))
+# частота, в которую ffmpeg декодирует аудио при потоковой нарезке (Whisper все равно работает с 16 кГц)
+STREAM_DECODE_FRAME_RATE = int(os.environ.get('STREAM_DECODE_FRAME_RATE', 16000))
+# целевая длина куска для Whisper и насколько можно сдвинуть границу, чтобы резать по тишине
+# (0 - резать ровно по TRANSCRIPTION_CHUNK_SECONDS). Кусок не длиннее суммы этих значений.
+TRANSCRIPTION_CHUNK_SECONDS = int(os.environ.get('TRANSCRIPTION_CHUNK_SECONDS', 120))
+TRANSCRIPTION_SILENCE_TOLERANCE_SECONDS = int(os.environ.get('TRANSCRIPTION_SILENCE_TOLERANCE_SECONDS', 10))
+# постоянный кэш транскрипций
+TRANSCRIPTION_CACHE_PATH = os.environ.get('TRANSCRIPTION_CACHE_PATH', 'transcription_cache.db')
+# максимальный суммарный размер транскриптов в кэше (0 - кэш выключен)
+TRANSCRIPTION_CACHE_MAX_BYTES = int(os.environ.get('TRANSCRIPTION_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+# пул соединений общего HTTP клиента (Whisper, Telegram file API).
+# HTTP_MAX_CONNECTIONS должен быть не меньше WHISPER_MAX_CONCURRENT_REQUESTS
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 32))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', 16))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 300))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import pathlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class SqliteDatabase:
+    """
+    SQLite database in WAL mode, used from the event loop and from executor threads.
+    Writes and reads go through separate connections with separate locks: under WAL a reader
+    sees the last committed data, so lookups don't wait for a write transaction to commit.
+    """
+
+    def __init__(self, path: str, schema: str):
+        """
+        :param path: Path to the database file, parent directories are created
+        :param schema: SQL script creating the tables and indexes if they don't exist
+        """
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.write_lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(schema)
+            self.connection.commit()
+        self.read_connection = sqlite3.connect(path, check_same_thread=False)
+
+    @contextmanager
+    def writing(self) -> Iterator[sqlite3.Connection]:
+        """
+        Runs a write transaction, committed on success and rolled back on error.
+        """
+        with self.write_lock, self.connection:
+            yield self.connection
+
+    @contextmanager
+    def reading(self) -> Iterator[sqlite3.Connection]:
+        """
+        Gives access to the read connection.
+        """
+        with self.read_lock:
+            yield self.read_connection
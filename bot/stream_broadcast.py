@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import asyncio
+from typing import AsyncIterable, AsyncIterator
+
+_END = object()
+
+
+class StreamBroadcast:
+    """
+    Reads a streamed response once and fans its chunks out to any number of subscribers.
+    Subscribers that join late first receive the chunks streamed so far.
+    """
+
+    def __init__(self, stream: AsyncIterable):
+        """
+        :param stream: The stream to read, reading starts right away
+        """
+        self.chunks = []
+        self.queues: list[asyncio.Queue] = []
+        self.error: Exception | None = None
+        self.done = False
+        self.task = asyncio.create_task(self.__pump(stream))
+
+    async def __pump(self, stream: AsyncIterable):
+        try:
+            async for chunk in stream:
+                self.chunks.append(chunk)
+                for queue in self.queues:
+                    queue.put_nowait(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            for queue in self.queues:
+                queue.put_nowait(_END)
+
+    async def subscribe(self) -> AsyncIterator:
+        """
+        Iterates over all chunks of the stream, raising the stream's error if it failed.
+        """
+        queue = asyncio.Queue()
+        for chunk in self.chunks:
+            queue.put_nowait(chunk)
+        if self.done:
+            queue.put_nowait(_END)
+        else:
+            self.queues.append(queue)
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is _END:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                yield chunk
+        finally:
+            if queue in self.queues:
+                self.queues.remove(queue)
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from telegram.error import RetryAfter, TimedOut
+
+from cache import TTLCache
+from token_bucket import TokenBucket, acquire_all
+
+# Telegram allows about 30 messages per second overall, one per second in a private chat
+# and 20 per minute in a group; message edits count against the same limits
+GLOBAL_EDITS_PER_SECOND = 25
+PRIVATE_CHAT_EDITS_PER_SECOND = 1
+GROUP_CHAT_EDITS_PER_SECOND = 20 / 60
+# attempts to deliver the final state of a message
+FINAL_EDIT_ATTEMPTS = 3
+
+_global_bucket = TokenBucket(rate=GLOBAL_EDITS_PER_SECOND, capacity=GLOBAL_EDITS_PER_SECOND)
+# buckets of recently active chats, an idle chat's bucket would be full again anyway
+_chat_buckets = TTLCache(maxsize=10000, ttl=60)
+
+
+def get_chat_bucket(chat_key, is_group: bool) -> TokenBucket:
+    """
+    Gets the edit flood budget of a chat (or of an inline message sender).
+    """
+    bucket = _chat_buckets.get(chat_key)
+    if bucket is None:
+        rate = GROUP_CHAT_EDITS_PER_SECOND if is_group else PRIVATE_CHAT_EDITS_PER_SECOND
+        bucket = TokenBucket(rate=rate, capacity=1)
+    _chat_buckets.set(chat_key, bucket)
+    return bucket
+
+
+class StreamRenderer:
+    """
+    Renders a streamed answer into a Telegram message. Intermediate states are coalesced
+    and only sent when the chat's and the bot's flood budgets allow an edit,
+    the final state is always delivered.
+    """
+
+    def __init__(self, edit: Callable[[str, bool], Awaitable], chat_key, is_group: bool = False):
+        """
+        :param edit: Coroutine function editing the message, called with the text and whether it is final
+        :param chat_key: The chat id, or the user id for inline messages
+        :param is_group: Whether the message is in a group chat (stricter flood limits)
+        """
+        self.edit = edit
+        self.chat_bucket = get_chat_bucket(chat_key, is_group)
+        self.sent_text: str | None = None
+
+    def mark_sent(self):
+        """
+        Counts a message sent by the caller (e.g. the first reply) against the chat's flood budget.
+        """
+        self.chat_bucket.consume()
+        _global_bucket.consume()
+
+    async def update(self, text: str):
+        """
+        Shows an intermediate state if an edit is allowed right now, otherwise skips it.
+        :param text: The full text streamed so far
+        """
+        if text == self.sent_text or self.chat_bucket.delay() > 0 or _global_bucket.delay() > 0:
+            return
+        self.mark_sent()
+        try:
+            await self.edit(text, False)
+            self.sent_text = text
+        except RetryAfter as e:
+            self.chat_bucket.block(e.retry_after)
+        except TimedOut:
+            self.chat_bucket.block(0.5)
+        except Exception as e:
+            logging.debug(f'Skipping failed stream edit: {str(e)}')
+
+    async def finish(self, text: str):
+        """
+        Shows the final state, waiting for the flood budgets and retrying if Telegram asks to.
+        :param text: The full text
+        """
+        for attempt in range(FINAL_EDIT_ATTEMPTS):
+            await acquire_all((self.chat_bucket, 1), (_global_bucket, 1))
+            try:
+                await self.edit(text, True)
+                self.sent_text = text
+                return
+            except RetryAfter as e:
+                self.chat_bucket.block(e.retry_after)
+            except TimedOut:
+                await asyncio.sleep(0.5)
+            except Exception as e:
+                logging.warning(f'Failed to send the final stream edit: {str(e)}')
+                return
+        logging.warning(f'Failed to send the final stream edit after {FINAL_EDIT_ATTEMPTS} attempts')
@@ -3,27 +3,40 @@ from __future__ import annotations
 import asyncio
 import logging
 import os
+from datetime import date
 
 from uuid import uuid4
 from telegram import BotCommandScopeAllGroupChats, Update, constants
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle
 from telegram import InputTextMessageContent, BotCommand
-from telegram.error import RetryAfter, TimedOut
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
-    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext
+    filters, InlineQueryHandler, CallbackQueryHandler, ChatMemberHandler, Application, ContextTypes, CallbackContext
 
 from pydub import AudioSegment
 
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
-    edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
-    get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler
+    edit_message_with_retry, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
+    get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, get_http_client, close_http_client, \
+    update_group_members, get_access_policy, load_usage_tracker
 from openai_helper import OpenAIHelper, localized_text
-from usage_tracker import UsageTracker
+from usage_tracker import UsageTrackerCache
+from usage_store import JsonUsageStore
+from cache import TTLCache
+from stream_renderer import StreamRenderer
+from concurrent_application import ChatOrderedApplication, MAX_SCHEDULED_UPDATES
 from kb import rate_dialog_kb
 from callback import callback_rate_dialog, look_transcribe_callback
 from handlers import audio_handler, video_handler
 from utils import is_subscribed_decorator
 
+# resend prompts and inline queries are kept for at most this many chats / queries
+MAX_CACHED_PROMPTS = 10000
+# seconds an inline query can wait for its answer button to be pressed
+INLINE_QUERY_TTL = 3600
+# seconds between sweeps of expired conversations and cached prompts
+EXPIRY_SWEEP_INTERVAL = 60
+# seconds admin /stats waits for the OpenAI billing API before using tracked usage
+BILLING_STATS_TIMEOUT = 3
 
 class ChatGPTTelegramBot:
     """
@@ -51,9 +64,13 @@ class ChatGPTTelegramBot:
         )] + self.commands
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
-        self.usage = {}
-        self.last_message = {}
-        self.inline_queries_cache = {}
+        self.usage = UsageTrackerCache(config['usage_cache_size'], config['usage_cache_idle_seconds'])
+        self.usage_flush_task: asyncio.Task | None = None
+        self.usage_flush_lock = asyncio.Lock()
+        self.conversation_flush_task: asyncio.Task | None = None
+        self.last_message = TTLCache(MAX_CACHED_PROMPTS, ttl=openai.config['max_conversation_age_minutes'] * 60)
+        self.inline_queries_cache = TTLCache(MAX_CACHED_PROMPTS, ttl=INLINE_QUERY_TTL)
+        self.expiry_task: asyncio.Task | None = None
 
     @is_subscribed_decorator
     async def help(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
@@ -89,18 +106,17 @@ class ChatGPTTelegramBot:
                      f'requested their usage statistics')
 
         user_id = update.message.from_user.id
-        if user_id not in self.usage:
-            self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+        usage_tracker = await load_usage_tracker(self.config, self.usage, user_id, update.message.from_user.name)
 
-        tokens_today, tokens_month = self.usage[user_id].get_current_token_usage()
-        images_today, images_month = self.usage[user_id].get_current_image_count()
+        tokens_today, tokens_month = usage_tracker.get_current_token_usage()
+        images_today, images_month = usage_tracker.get_current_image_count()
         (transcribe_minutes_today, transcribe_seconds_today, transcribe_minutes_month,
-         transcribe_seconds_month) = self.usage[user_id].get_current_transcription_duration()
-        current_cost = self.usage[user_id].get_current_cost()
+         transcribe_seconds_month) = usage_tracker.get_current_transcription_duration()
+        current_cost = usage_tracker.get_current_cost()
 
         chat_id = update.effective_chat.id
-        chat_messages, chat_token_length = self.openai.get_conversation_stats(chat_id)
-        remaining_budget = get_remaining_budget(self.config, self.usage, update)
+        chat_messages, chat_token_length = await self.openai.get_conversation_stats(chat_id)
+        remaining_budget = await get_remaining_budget(self.config, self.usage, update)
         bot_language = self.config['bot_language']
         text_current_conversation = (
             f"*{localized_text('stats_conversation', bot_language)[0]}*:\n"
@@ -138,12 +154,29 @@ class ChatGPTTelegramBot:
         if is_admin(self.config, user_id):
             text_budget += (
                 f"{localized_text('stats_openai', bot_language)}"
-                f"{self.openai.get_billing_current_month():.2f}"
+                f"{await self.get_billing_current_month()}"
             )
 
         usage_text = text_current_conversation + text_today + text_month + text_budget
         await update.message.reply_text(usage_text, parse_mode=constants.ParseMode.MARKDOWN)
 
+    async def get_billing_current_month(self) -> str:
+        """
+        Gets the billed usage of the current month from OpenAI, or an estimate
+        from the tracked usage if the billing API does not answer in time.
+        :return: The formatted dollar amount, prefixed with ~ for estimates
+        """
+        try:
+            return f"{await asyncio.wait_for(self.openai.get_billing_current_month(), BILLING_STATS_TIMEOUT):.2f}"
+        except Exception as e:
+            logging.warning(f'Failed to get billed usage from OpenAI, using tracked usage instead: {str(e)}')
+
+        await self.flush_usage()
+        store = self.config.get('usage_store') or JsonUsageStore()
+        month = date.today().strftime('%Y-%m')
+        cost = await asyncio.get_running_loop().run_in_executor(None, store.get_month_cost, month)
+        return f"~{cost:.2f}"
+
     @is_subscribed_decorator
     async def resend(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -224,10 +257,14 @@ class ChatGPTTelegramBot:
                 )
                 # add image request to users usage tracker
                 user_id = update.message.from_user.id
-                self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
+                user_tracker = await load_usage_tracker(self.config, self.usage, user_id,
+                                                        update.message.from_user.name)
+                user_tracker.add_image_request(image_size, self.config['image_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
-                    self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
+                if not get_access_policy(self.config).is_allowed_user(user_id):
+                    guest_tracker = await load_usage_tracker(self.config, self.usage, 'guests',
+                                                             'all guest users in group chats')
+                    guest_tracker.add_image_request(image_size, self.config['image_prices'])
 
             except Exception as e:
                 logging.exception(e)
@@ -256,7 +293,7 @@ class ChatGPTTelegramBot:
         chat_id = update.effective_chat.id
         user_id = update.message.from_user.id
         prompt = message_text(update.message)
-        self.last_message[chat_id] = prompt
+        self.last_message.set(chat_id, prompt)
 
         if is_group_chat(update):
             trigger_keyword = self.config['group_trigger_keyword']
@@ -288,12 +325,15 @@ class ChatGPTTelegramBot:
                     )
 
                     stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt)
-                    i = 0
-                    prev = ''
                     sent_message = None
-                    backoff = 0
                     stream_chunk = 0
 
+                    async def edit(text, final):
+                        await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
+                                                      text=text, markdown=final)
+
+                    renderer = StreamRenderer(edit, chat_id, is_group=is_group_chat(update))
+
                     async for content, tokens in stream_response:
                         if len(content.strip()) == 0:
                             continue
@@ -303,63 +343,35 @@ class ChatGPTTelegramBot:
                             content = stream_chunks[-1]
                             if stream_chunk != len(stream_chunks) - 1:
                                 stream_chunk += 1
-                                try:
-                                    await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                                  stream_chunks[-2])
-                                except:
-                                    pass
+                                await renderer.finish(stream_chunks[-2])
                                 try:
                                     sent_message = await update.effective_message.reply_text(
                                         message_thread_id=get_thread_id(update),
                                         text=content if len(content) > 0 else "..."
                                     )
+                                    renderer.mark_sent()
+                                    renderer.sent_text = content
                                 except:
                                     pass
                                 continue
 
-                        cutoff = get_stream_cutoff_values(update, content)
-                        cutoff += backoff
-
-                        if i == 0:
+                        if sent_message is None:
                             try:
-                                if sent_message is not None:
-                                    await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                     message_id=sent_message.message_id)
                                 sent_message = await update.effective_message.reply_text(
                                     message_thread_id=get_thread_id(update),
                                     reply_to_message_id=get_reply_to_message_id(self.config, update),
                                     text=content
                                 )
+                                renderer.mark_sent()
+                                renderer.sent_text = content
                             except:
                                 continue
 
-                        elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                            prev = content
-
-                            try:
-                                use_markdown = tokens != 'not_finished'
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              text=content, markdown=use_markdown)
-
-                            except RetryAfter as e:
-                                backoff += 5
-                                await asyncio.sleep(e.retry_after)
-                                continue
-
-                            except TimedOut:
-                                backoff += 5
-                                await asyncio.sleep(0.5)
-                                continue
-
-                            except Exception:
-                                backoff += 5
-                                continue
-
-                            await asyncio.sleep(0.01)
-
-                        i += 1
                         if tokens != 'not_finished':
+                            await renderer.finish(content)
                             total_tokens = int(tokens)
+                        else:
+                            await renderer.update(content)
 
                 await wrap_with_indicator(update, context, _reply, constants.ChatAction.TYPING)
 
@@ -393,7 +405,8 @@ class ChatGPTTelegramBot:
 
                 await wrap_with_indicator(update, context, _reply, constants.ChatAction.TYPING)
 
-            add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+            await add_chat_request_to_usage_tracker(self.usage, self.config, user_id,
+                                                    update.message.from_user.name, total_tokens)
 
         except Exception as e:
             logging.exception(e)
@@ -416,7 +429,7 @@ class ChatGPTTelegramBot:
 
         callback_data_suffix = "gpt:"
         result_id = str(uuid4())
-        self.inline_queries_cache[result_id] = query
+        self.inline_queries_cache.set(result_id, query)
         callback_data = f'{callback_data_suffix}{result_id}'
 
         await self.send_inline_query_result(update, result_id, message_content=query, callback_data=callback_data)
@@ -485,55 +498,27 @@ class ChatGPTTelegramBot:
 
                 if self.config['stream']:
                     stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
-                    i = 0
-                    prev = ''
-                    backoff = 0
-                    async for content, tokens in stream_response:
-                        if len(content.strip()) == 0:
-                            continue
-
-                        cutoff = get_stream_cutoff_values(update, content)
-                        cutoff += backoff
-
-                        if i == 0:
-                            try:
-                                await edit_message_with_retry(context, chat_id=None,
-                                                              message_id=inline_message_id,
-                                                              text=f'{query}\n\n{answer_tr}:\n{content}',
-                                                              is_inline=True)
-                            except:
-                                continue
-
-                        elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                            prev = content
-                            try:
-                                use_markdown = tokens != 'not_finished'
-                                divider = '_' if use_markdown else ''
-                                text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
 
-                                # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                                text = text[:4096]
+                    async def edit(content, final):
+                        divider = '_' if final else ''
+                        text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
 
-                                await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
-                                                              text=text, markdown=use_markdown, is_inline=True)
+                        # We only want to send the first 4096 characters. No chunking allowed in inline mode.
+                        text = text[:4096]
 
-                            except RetryAfter as e:
-                                backoff += 5
-                                await asyncio.sleep(e.retry_after)
-                                continue
-                            except TimedOut:
-                                backoff += 5
-                                await asyncio.sleep(0.5)
-                                continue
-                            except Exception:
-                                backoff += 5
-                                continue
+                        await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                      text=text, markdown=final, is_inline=True)
 
-                            await asyncio.sleep(0.01)
+                    renderer = StreamRenderer(edit, user_id)
+                    async for content, tokens in stream_response:
+                        if len(content.strip()) == 0:
+                            continue
 
-                        i += 1
                         if tokens != 'not_finished':
+                            await renderer.finish(content)
                             total_tokens = int(tokens)
+                        else:
+                            await renderer.update(content)
 
                 else:
                     async def _send_inline_query_response():
@@ -558,7 +543,7 @@ class ChatGPTTelegramBot:
                     await wrap_with_indicator(update, context, _send_inline_query_response,
                                               constants.ChatAction.TYPING, is_inline=True)
 
-                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+                await add_chat_request_to_usage_tracker(self.usage, self.config, user_id, name, total_tokens)
 
         except Exception as e:
             logging.error(f'Failed to respond to an inline query via button callback: {e}')
@@ -585,7 +570,7 @@ class ChatGPTTelegramBot:
             logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
             await self.send_disallowed_message(update, context, is_inline)
             return False
-        if not is_within_budget(self.config, self.usage, update, is_inline=is_inline):
+        if not await is_within_budget(self.config, self.usage, update, is_inline=is_inline):
             logging.warning(f'User {name} (id: {user_id}) reached their usage limit')
             await self.send_budget_reached_message(update, context, is_inline)
             return False
@@ -620,23 +605,112 @@ class ChatGPTTelegramBot:
             result_id = str(uuid4())
             await self.send_inline_query_result(update, result_id, message_content=self.budget_limit_message)
 
+    async def track_chat_members(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Keeps the cached authorized members of group chats up to date.
+        """
+        update_group_members(self.config, update)
+
     async def post_init(self, application: Application) -> None:
         """
         Post initialization hook for the bot.
         """
+        get_http_client()
+        if self.config['usage_flush_interval'] > 0:
+            self.usage_flush_task = asyncio.create_task(self.flush_usage_periodically())
+        if self.config['conversation_flush_interval'] > 0:
+            self.conversation_flush_task = asyncio.create_task(self.flush_conversations_periodically())
+        self.expiry_task = asyncio.create_task(self.expire_periodically())
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
 
+    async def post_shutdown(self, application: Application) -> None:
+        """
+        Post shutdown hook for the bot.
+        """
+        if self.usage_flush_task is not None:
+            self.usage_flush_task.cancel()
+        if self.conversation_flush_task is not None:
+            self.conversation_flush_task.cancel()
+        if self.expiry_task is not None:
+            self.expiry_task.cancel()
+        await self.flush_usage()
+        await self.openai.flush_conversations()
+        await close_http_client()
+
+    async def flush_usage(self):
+        """
+        Writes all usage trackers with unsaved changes to disk.
+        Flushes run one at a time, so that an older snapshot can't overwrite a newer one.
+        """
+        async def _flush():
+            async with self.usage_flush_lock:
+                self.usage.evict_idle()
+                for tracker in self.usage.values():
+                    if tracker.dirty:
+                        try:
+                            await tracker.flush_async()
+                        except Exception as e:
+                            logging.warning(f'Failed to write usage_logs for user {tracker.user_id}: {str(e)}')
+                self.usage.drop_flushed()
+
+        # a cancelled caller (e.g. the periodic flush on shutdown) must not release the lock mid-write
+        await asyncio.shield(_flush())
+        logging.debug(f'Usage tracker cache: {len(self.usage)} trackers, {self.usage.hits} hits, '
+                      f'{self.usage.misses} misses, {self.usage.evictions} evictions')
+
+    async def flush_usage_periodically(self):
+        """
+        Flushes usage trackers every usage_flush_interval seconds (write-behind mode).
+        """
+        while True:
+            await asyncio.sleep(self.config['usage_flush_interval'])
+            await self.flush_usage()
+
+    async def flush_conversations_periodically(self):
+        """
+        Writes changed conversations to the conversation store every conversation_flush_interval seconds.
+        """
+        while True:
+            await asyncio.sleep(self.config['conversation_flush_interval'])
+            await self.openai.flush_conversations()
+
+    async def expire_periodically(self):
+        """
+        Removes expired conversations, resend prompts and inline queries every EXPIRY_SWEEP_INTERVAL seconds.
+        """
+        while True:
+            await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+            try:
+                expired = self.openai.expire_conversations()
+                self.last_message.expire()
+                self.inline_queries_cache.expire()
+                if expired:
+                    logging.info(f'Removed {expired} expired conversations')
+            except Exception as e:
+                logging.warning(f'Failed to remove expired conversations: {str(e)}')
+
     def run(self):
         """
         Runs the bot indefinitely until the user presses Ctrl+C
         """
-        application = ApplicationBuilder() \
+        builder = ApplicationBuilder() \
             .token(self.config['token']) \
             .base_url('http://telegram-bot-api:8081/bot')\
             .base_file_url('http://telegram-bot-api:8081/bot/file')\
             .read_timeout(None)\
-            .write_timeout(None).build()
+            .write_timeout(None)\
+            .post_init(self.post_init)\
+            .post_shutdown(self.post_shutdown)
+
+        if self.config['concurrent_updates'] > 0:
+            # process different chats concurrently, but keep updates of the same chat in order
+            builder = builder \
+                .application_class(ChatOrderedApplication,
+                                   kwargs={'max_concurrent_updates': self.config['concurrent_updates']}) \
+                .concurrent_updates(MAX_SCHEDULED_UPDATES)
+
+        application = builder.build()
 
         application.add_handler(CommandHandler('reset', self.reset))
         application.add_handler(CommandHandler('help', self.help))
@@ -656,7 +730,9 @@ class ChatGPTTelegramBot:
             constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.PRIVATE
         ]))
         application.add_handler(CallbackQueryHandler(self.handle_callback_inline_query))
+        application.add_handler(ChatMemberHandler(self.track_chat_members, ChatMemberHandler.ANY_CHAT_MEMBER))
 
         application.add_error_handler(error_handler)
 
-        application.run_polling()
+        # chat_member updates are only delivered when requested explicitly
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: holds up to capacity tokens and refills at rate tokens per second.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        :param rate: Number of tokens added per second
+        :param capacity: Maximum number of tokens (the allowed burst)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, amount: float = 1) -> float:
+        """
+        Gets the number of seconds until amount tokens are available.
+        Amounts above the capacity only wait for a full bucket.
+        """
+        self.__refill()
+        now = time.monotonic()
+        missing = min(amount, self.capacity) - self.tokens
+        wait = missing / self.rate if missing > 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, amount: float = 1):
+        """
+        Takes amount tokens, the balance may go negative for amounts above the capacity.
+        """
+        self.__refill()
+        self.tokens -= amount
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        """
+        Takes amount tokens if they are available right away.
+        :return: True if the tokens were taken
+        """
+        if self.delay(amount) > 0:
+            return False
+        self.consume(amount)
+        return True
+
+    async def acquire(self, amount: float = 1):
+        """
+        Waits until amount tokens are available and takes them.
+        """
+        await acquire_all((self, amount))
+
+    def block(self, seconds: float):
+        """
+        Blocks the bucket for the given number of seconds, e.g. after a rate limit error.
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def __refill(self):
+        now = time.monotonic()
+        if self.tokens < self.capacity:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+async def acquire_all(*requests: tuple[TokenBucket, float]):
+    """
+    Waits until all buckets have the requested tokens and takes them at once.
+    :param requests: (bucket, amount) pairs
+    """
+    while True:
+        delay = max(bucket.delay(amount) for bucket, amount in requests)
+        if delay <= 0:
+            for bucket, amount in requests:
+                bucket.consume(amount)
+            return
+        await asyncio.sleep(delay)
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import sqlite3
+import time
+
+import settings
+from sqlite_db import SqliteDatabase
+
+# сколько попаданий копить в памяти, прежде чем записать время доступа в базу
+ACCESS_BATCH_SIZE = 100
+
+
+class TranscriptionCache:
+    """
+    Постоянный кэш транскрипций в SQLite с LRU-вытеснением по суммарному размеру текстов.
+    Ключи:
+        file:<file_unique_id> - транскрипт целого файла из Telegram
+        chunk:<sha256>        - транскрипт одного куска аудио (хэш от PCM данных куска)
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        """
+        :param path: путь к файлу базы
+        :param max_bytes: максимальный суммарный размер транскриптов в байтах
+        """
+        self.max_bytes = max_bytes
+        # время последних попаданий {key: timestamp}, пишется в базу пачкой
+        self.accessed: dict[str, float] = {}
+        # база используется из потоков asyncio.to_thread, поиск транскрипта не ждет записи нового
+        self.db = SqliteDatabase(path, '''
+            CREATE TABLE IF NOT EXISTS transcriptions (
+                key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS transcriptions_last_access ON transcriptions (last_access);
+        ''')
+        with self.db.reading() as connection:
+            self.total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM transcriptions').fetchone()[0]
+
+    async def get(self, key: str) -> str | None:
+        """
+        возвращает транскрипт по ключу и отмечает его как недавно использованный.
+        Время доступа сначала запоминается в памяти и пишется в базу при следующем set
+        или когда наберется ACCESS_BATCH_SIZE попаданий.
+        """
+        text = await asyncio.to_thread(self.__read, key)
+        if text is not None:
+            self.accessed[key] = time.time()
+            if len(self.accessed) >= ACCESS_BATCH_SIZE:
+                accessed, self.accessed = self.accessed, {}
+                await asyncio.to_thread(self.__write, accessed)
+        return text
+
+    async def set(self, key: str, text: str):
+        """
+        сохраняет транскрипт и вытесняет самые давно использованные записи, если кэш переполнен.
+        """
+        accessed, self.accessed = self.accessed, {}
+        await asyncio.to_thread(self.__write, accessed, key, text)
+
+    def __read(self, key: str) -> str | None:
+        with self.db.reading() as connection:
+            row = connection.execute('SELECT text FROM transcriptions WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __write(self, accessed: dict[str, float], key: str | None = None, text: str | None = None):
+        with self.db.writing() as connection:
+            connection.executemany('UPDATE transcriptions SET last_access = ? WHERE key = ?',
+                                   [(last_access, accessed_key) for accessed_key, last_access in accessed.items()])
+            if key is not None:
+                self.__insert(connection, key, text)
+
+    def __insert(self, connection: sqlite3.Connection, key: str, text: str):
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        row = connection.execute('SELECT size FROM transcriptions WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.total_size -= row[0]
+        connection.execute(
+            'INSERT OR REPLACE INTO transcriptions (key, text, size, last_access) VALUES (?, ?, ?, ?)',
+            (key, text, size, time.time())
+        )
+        self.total_size += size
+        self.__evict(connection)
+
+    def __evict(self, connection: sqlite3.Connection):
+        while self.total_size > self.max_bytes:
+            rows = connection.execute(
+                'SELECT key, size FROM transcriptions ORDER BY last_access LIMIT 100'
+            ).fetchall()
+            if not rows:
+                self.total_size = 0
+                return
+            for key, size in rows:
+                if self.total_size <= self.max_bytes:
+                    break
+                connection.execute('DELETE FROM transcriptions WHERE key = ?', (key,))
+                self.total_size -= size
+
+
+def file_key(file_unique_id: str) -> str:
+    return f'file:{file_unique_id}'
+
+
+def chunk_key(raw_data: bytes) -> str:
+    return f'chunk:{hashlib.sha256(raw_data).hexdigest()}'
+
+
+_transcription_cache: TranscriptionCache | None = None
+
+
+def get_transcription_cache() -> TranscriptionCache | None:
+    """
+    Общий кэш транскрипций, открывается при первом обращении.
+    Возвращает None, если кэш выключен (TRANSCRIPTION_CACHE_MAX_BYTES = 0).
+    """
+    global _transcription_cache
+    if settings.TRANSCRIPTION_CACHE_MAX_BYTES <= 0:
+        return None
+    if _transcription_cache is None:
+        _transcription_cache = TranscriptionCache(settings.TRANSCRIPTION_CACHE_PATH,
+                                                  settings.TRANSCRIPTION_CACHE_MAX_BYTES)
+    return _transcription_cache
@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import abc
+import argparse
+import json
+import logging
+import os
+import pathlib
+import threading
+
+from sqlite_db import SqliteDatabase
+
+IMAGE_SIZES = ["256x256", "512x512", "1024x1024"]
+
+
+class UsageStore(abc.ABC):
+    """
+    Storage backend for UsageTracker data.
+    Writes are split in two steps: snapshot() runs in the event loop and captures the data
+    to write, write() may then run on an executor thread.
+    """
+
+    @abc.abstractmethod
+    def load(self, user_id) -> dict | None:
+        """
+        Loads the usage data of a user.
+        :param user_id: Telegram ID of the user
+        :return: usage dictionary in the UsageTracker format, or None if the user has no data yet
+        """
+
+    @abc.abstractmethod
+    def snapshot(self, user_id, usage: dict, changed_days: set) -> object:
+        """
+        Captures the data that needs to be written.
+        :param user_id: Telegram ID of the user
+        :param usage: usage dictionary in the UsageTracker format
+        :param changed_days: set of (metric, day) pairs changed since the last write
+        :return: data to pass to write()
+        """
+
+    @abc.abstractmethod
+    def write(self, user_id, data):
+        """
+        Writes data captured by snapshot().
+        """
+
+    @abc.abstractmethod
+    def get_month_cost(self, month: str) -> float:
+        """
+        Sums the cost of all users (without the shared guest tracker) in the given month.
+        :param month: year-month as string, e.g. '2023-03'
+        :return: total cost in USD
+        """
+
+
+class JsonUsageStore(UsageStore):
+    """
+    Stores the usage of each user as a JSON file in the logs directory.
+    """
+
+    def __init__(self, logs_dir="usage_logs"):
+        self.logs_dir = logs_dir
+        self.write_lock = threading.Lock()
+        # ensure directory exists
+        pathlib.Path(logs_dir).mkdir(exist_ok=True)
+
+    def user_file(self, user_id):
+        return f"{self.logs_dir}/{user_id}.json"
+
+    def load(self, user_id) -> dict | None:
+        if not os.path.isfile(self.user_file(user_id)):
+            return None
+        with open(self.user_file(user_id), "r") as file:
+            return json.load(file)
+
+    def snapshot(self, user_id, usage: dict, changed_days: set) -> str:
+        return json.dumps(usage)
+
+    def write(self, user_id, data: str):
+        """
+        Atomically replaces the user file: writes a temporary file and renames it.
+        """
+        user_file = self.user_file(user_id)
+        with self.write_lock:
+            temp_file = f"{user_file}.tmp"
+            with open(temp_file, "w") as outfile:
+                outfile.write(data)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(temp_file, user_file)
+
+    def get_month_cost(self, month: str) -> float:
+        total = 0.0
+        for path in pathlib.Path(self.logs_dir).glob("*.json"):
+            if path.stem == "guests":
+                continue
+            try:
+                with open(path, "r") as file:
+                    current_cost = json.load(file)["current_cost"]
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Skipping unreadable usage file {path}: {str(e)}")
+                continue
+            if current_cost["last_update"].startswith(month):
+                total += current_cost["month"]
+        return total
+
+
+class SqliteUsageStore(UsageStore):
+    """
+    Stores usage in a SQLite database (WAL mode) with one row per (user, day, metric).
+    Image counts are stored as one metric per image size, e.g. number_images_512x512.
+    """
+
+    def __init__(self, db_path="usage_logs/usage.db"):
+        # trackers are loaded while the periodic flush may be writing
+        self.db = SqliteDatabase(db_path, '''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                user_name TEXT,
+                cost_day REAL NOT NULL,
+                cost_month REAL NOT NULL,
+                cost_all_time REAL,
+                last_update TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS usage (
+                user_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (user_id, day, metric)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS usage_metric_day ON usage (metric, day);
+        ''')
+
+    def load(self, user_id) -> dict | None:
+        with self.db.reading() as connection:
+            user = connection.execute(
+                'SELECT user_name, cost_day, cost_month, cost_all_time, last_update FROM users WHERE user_id = ?',
+                (str(user_id),)
+            ).fetchone()
+            if user is None:
+                return None
+            rows = connection.execute(
+                'SELECT day, metric, value FROM usage WHERE user_id = ? ORDER BY day', (str(user_id),)
+            ).fetchall()
+
+        user_name, cost_day, cost_month, cost_all_time, last_update = user
+        current_cost = {"day": cost_day, "month": cost_month, "last_update": last_update}
+        if cost_all_time is not None:
+            current_cost["all_time"] = cost_all_time
+        history = {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}}
+        for day, metric, value in rows:
+            if metric.startswith("number_images_"):
+                images = history["number_images"].setdefault(day, [0, 0, 0])
+                images[IMAGE_SIZES.index(metric[len("number_images_"):])] = int(value)
+            elif metric == "chat_tokens":
+                history[metric][day] = int(value)
+            else:
+                history[metric][day] = value
+        return {"user_name": user_name, "current_cost": current_cost, "usage_history": history}
+
+    def snapshot(self, user_id, usage: dict, changed_days: set | None) -> tuple:
+        """
+        Captures the user row and the usage rows of the changed days (all days if changed_days is None).
+        """
+        current_cost = usage["current_cost"]
+        user_row = (str(user_id), usage["user_name"], current_cost["day"], current_cost["month"],
+                    current_cost.get("all_time"), current_cost["last_update"])
+        history = usage["usage_history"]
+        if changed_days is None:
+            changed_days = {(metric, day) for metric, days in history.items() for day in days}
+        usage_rows = []
+        for metric, day in changed_days:
+            value = history[metric][day]
+            if metric == "number_images":
+                usage_rows += [(str(user_id), day, f"number_images_{size}", count)
+                               for size, count in zip(IMAGE_SIZES, value)]
+            else:
+                usage_rows.append((str(user_id), day, metric, value))
+        return user_row, usage_rows
+
+    def write(self, user_id, data: tuple):
+        user_row, usage_rows = data
+        with self.db.writing() as connection:
+            connection.execute(
+                'INSERT INTO users (user_id, user_name, cost_day, cost_month, cost_all_time, last_update) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (user_id) DO UPDATE SET user_name = excluded.user_name, cost_day = excluded.cost_day, '
+                'cost_month = excluded.cost_month, cost_all_time = excluded.cost_all_time, '
+                'last_update = excluded.last_update',
+                user_row
+            )
+            connection.executemany(
+                'INSERT INTO usage (user_id, day, metric, value) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (user_id, day, metric) DO UPDATE SET value = excluded.value',
+                usage_rows
+            )
+
+    def get_month_cost(self, month: str) -> float:
+        with self.db.reading() as connection:
+            return connection.execute(
+                "SELECT COALESCE(SUM(cost_month), 0) FROM users WHERE user_id != 'guests' AND last_update LIKE ?",
+                (f"{month}-%",)
+            ).fetchone()[0]
+
+
+def create_usage_store(store_type="json", logs_dir="usage_logs", db_path="usage_logs/usage.db") -> UsageStore:
+    """
+    Creates the usage store backend of the given type ('json' or 'sqlite').
+    """
+    if store_type == "sqlite":
+        return SqliteUsageStore(db_path)
+    if store_type != "json":
+        logging.warning(f"Unknown usage store '{store_type}', falling back to json")
+    return JsonUsageStore(logs_dir)
+
+
+def migrate_json_to_sqlite(logs_dir="usage_logs", db_path="usage_logs/usage.db") -> int:
+    """
+    Copies all JSON usage files into the SQLite usage store.
+    :return: number of migrated users
+    """
+    json_store = JsonUsageStore(logs_dir)
+    sqlite_store = SqliteUsageStore(db_path)
+    migrated = 0
+    for path in sorted(pathlib.Path(logs_dir).glob("*.json")):
+        user_id = path.stem
+        usage = json_store.load(user_id)
+        sqlite_store.write(user_id, sqlite_store.snapshot(user_id, usage, None))
+        migrated += 1
+    return migrated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate JSON usage logs into the SQLite usage store.')
+    parser.add_argument('--logs-dir', default='usage_logs')
+    parser.add_argument('--db-path', default='usage_logs/usage.db')
+    args = parser.parse_args()
+    print(f'Migrated {migrate_json_to_sqlite(args.logs_dir, args.db_path)} users to {args.db_path}')
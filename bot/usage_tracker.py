@@ -1,19 +1,34 @@
-import os.path
-import pathlib
-import json
+import asyncio
+import time
+from collections import OrderedDict
 from datetime import date
 
+from usage_store import UsageStore, JsonUsageStore
+
+USAGE_METRICS = ("chat_tokens", "transcription_seconds", "number_images")
+
 
 def year_month(date_str):
     # extract string of year-month from date, eg: '2023-03'
     return str(date_str)[:7]
 
 
+def zero_usage(metric):
+    # image counts are kept per size, all other metrics as a single number
+    return [0, 0, 0] if metric == "number_images" else 0
+
+
+def add_usage(total, value):
+    if isinstance(total, list):
+        return [a + b for a, b in zip(total, value)]
+    return total + value
+
+
 class UsageTracker:
     """
     UsageTracker class
     Enables tracking of daily/monthly usage per user.
-    User files are stored as JSON in /usage_logs directory.
+    Usage is stored by a UsageStore backend, by default as JSON files in /usage_logs directory.
     JSON example:
     {
         "user_name": "@user_name",
@@ -40,31 +55,37 @@ class UsageTracker:
     }
     """
 
-    def __init__(self, user_id, user_name, logs_dir="usage_logs"):
+    def __init__(self, user_id, user_name, logs_dir="usage_logs", write_behind=False, store: UsageStore = None):
         """
         Initializes UsageTracker for a user with current date.
-        Loads usage data from usage log file.
+        Loads usage data from the usage store.
         :param user_id: Telegram ID of the user
         :param user_name: Telegram user name
-        :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
+        :param logs_dir: path to directory of usage logs, defaults to "usage_logs", used if no store is given
+        :param write_behind: if True, changes are only marked dirty and written by flush()/flush_async(),
+                             otherwise the usage is written on every change
+        :param store: usage storage backend, defaults to JSON files in logs_dir
         """
         self.user_id = user_id
-        self.logs_dir = logs_dir
-        # path to usage file of given user
-        self.user_file = f"{logs_dir}/{user_id}.json"
-
-        if os.path.isfile(self.user_file):
-            with open(self.user_file, "r") as file:
-                self.usage = json.load(file)
-        else:
-            # ensure directory exists
-            pathlib.Path(logs_dir).mkdir(exist_ok=True)
+        self.store = store if store is not None else JsonUsageStore(logs_dir)
+        self.write_behind = write_behind
+        self.dirty = False
+        # True while flush_async() is writing, the store may not have the latest data yet
+        self.writing = False
+        # (metric, day) pairs changed since the last write
+        self.changed_days = set()
+
+        self.usage = self.store.load(user_id)
+        if self.usage is None:
             # create new dictionary for this user
             self.usage = {
                 "user_name": user_name,
                 "current_cost": {"day": 0.0, "month": 0.0, "all_time": 0.0, "last_update": str(date.today())},
                 "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}}
             }
+        for metric in USAGE_METRICS:
+            self.usage["usage_history"].setdefault(metric, {})
+        self.__init_period_totals()
 
     # token usage functions:
 
@@ -84,27 +105,18 @@ class UsageTracker:
         else:
             # create new entry for current date
             self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
+        self.changed_days.add(("chat_tokens", str(today)))
+        self.__add_period_usage("chat_tokens", tokens)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.save()
 
     def get_current_token_usage(self):
         """Get token amounts used for today and this month
 
         :return: total number of tokens used per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            usage_day = self.usage["usage_history"]["chat_tokens"][str(today)]
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, tokens in self.usage["usage_history"]["chat_tokens"].items():
-            if today.startswith(month):
-                usage_month += tokens
-        return usage_day, usage_month
+        totals = self.__get_period_totals("chat_tokens")
+        return totals["day_total"], totals["month_total"]
 
     # image usage functions:
 
@@ -129,27 +141,20 @@ class UsageTracker:
             # create new entry for current date
             self.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
             self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
+        self.changed_days.add(("number_images", str(today)))
+        image_count = zero_usage("number_images")
+        image_count[requested_size] = 1
+        self.__add_period_usage("number_images", image_count)
 
-        # write updated image number to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.save()
 
     def get_current_image_count(self):
         """Get number of images requested for today and this month.
 
         :return: total number of images requested per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            usage_day = sum(self.usage["usage_history"]["number_images"][str(today)])
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, images in self.usage["usage_history"]["number_images"].items():
-            if today.startswith(month):
-                usage_month += sum(images)
-        return usage_day, usage_month
+        totals = self.__get_period_totals("number_images")
+        return sum(totals["day_total"]), sum(totals["month_total"])
 
     # transcription usage functions:
 
@@ -169,10 +174,10 @@ class UsageTracker:
         else:
             # create new entry for current date
             self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
+        self.changed_days.add(("transcription_seconds", str(today)))
+        self.__add_period_usage("transcription_seconds", seconds)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.save()
 
     def add_current_costs(self, request_cost):
         """
@@ -201,20 +206,91 @@ class UsageTracker:
 
         :return: total amount of time transcribed per day and per month (4 values)
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            seconds_day = self.usage["usage_history"]["transcription_seconds"][str(today)]
-        else:
-            seconds_day = 0
-        month = str(today)[:7]  # year-month as string
-        seconds_month = 0
-        for today, seconds in self.usage["usage_history"]["transcription_seconds"].items():
-            if today.startswith(month):
-                seconds_month += seconds
+        totals = self.__get_period_totals("transcription_seconds")
+        seconds_day, seconds_month = totals["day_total"], totals["month_total"]
         minutes_day, seconds_day = divmod(seconds_day, 60)
         minutes_month, seconds_month = divmod(seconds_month, 60)
         return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
 
+    # period totals functions
+
+    def __init_period_totals(self):
+        """Computes the day, month and all-time totals of every metric from the usage history once,
+        later requests update them incrementally.
+        """
+        today = str(date.today())
+        month = year_month(today)
+        self.period_totals = {}
+        for metric in USAGE_METRICS:
+            history = self.usage["usage_history"][metric]
+            month_total = all_time_total = zero_usage(metric)
+            for day, value in history.items():
+                all_time_total = add_usage(all_time_total, value)
+                if day.startswith(month):
+                    month_total = add_usage(month_total, value)
+            self.period_totals[metric] = {
+                "day": today,
+                # a copy, the history entry of today is updated separately
+                "day_total": add_usage(zero_usage(metric), history.get(today, zero_usage(metric))),
+                "month": month,
+                "month_total": month_total,
+                "all_time_total": all_time_total,
+            }
+
+    def __get_period_totals(self, metric):
+        """Gets the running totals of a metric, resetting the day and month totals on date change.
+        """
+        totals = self.period_totals[metric]
+        today = str(date.today())
+        if totals["day"] != today:
+            totals["day"], totals["day_total"] = today, zero_usage(metric)
+            if totals["month"] != year_month(today):
+                totals["month"], totals["month_total"] = year_month(today), zero_usage(metric)
+        return totals
+
+    def __add_period_usage(self, metric, value):
+        totals = self.__get_period_totals(metric)
+        totals["day_total"] = add_usage(totals["day_total"], value)
+        totals["month_total"] = add_usage(totals["month_total"], value)
+        totals["all_time_total"] = add_usage(totals["all_time_total"], value)
+
+    # persistence functions
+
+    def save(self):
+        """Writes the user file, or only marks it dirty in write-behind mode.
+        """
+        if self.write_behind:
+            self.dirty = True
+        else:
+            self.flush()
+
+    def flush(self):
+        """Writes the usage data to the usage store.
+        """
+        self.store.write(self.user_id, self.__snapshot())
+
+    async def flush_async(self):
+        """Writes the usage data to the usage store on an executor thread.
+        The data is captured first, so later changes are left for the next flush.
+        """
+        changed_days = self.changed_days
+        data = self.__snapshot()
+        self.writing = True
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.store.write, self.user_id, data)
+        except Exception:
+            self.dirty = True
+            self.changed_days |= changed_days
+            raise
+        finally:
+            self.writing = False
+
+    def __snapshot(self):
+        data = self.store.snapshot(self.user_id, self.usage, self.changed_days)
+        self.dirty = False
+        self.changed_days = set()
+        return data
+
     # general functions
     def get_current_cost(self):
         """Get total USD amount of all requests of the current day and month
@@ -245,15 +321,95 @@ class UsageTracker:
         :param minute_price: price per minute transcription, defaults to 0.006
         :return: total cost of all requests
         """
-        total_tokens = sum(self.usage['usage_history']['chat_tokens'].values())
+        total_tokens = self.period_totals['chat_tokens']['all_time_total']
         token_cost = round(total_tokens * tokens_price / 1000, 6)
 
-        total_images = [sum(values) for values in zip(*self.usage['usage_history']['number_images'].values())]
+        total_images = self.period_totals['number_images']['all_time_total']
         image_prices_list = [float(x) for x in image_prices.split(',')]
         image_cost = sum([count * price for count, price in zip(total_images, image_prices_list)])
 
-        total_transcription_seconds = sum(self.usage['usage_history']['transcription_seconds'].values())
+        total_transcription_seconds = self.period_totals['transcription_seconds']['all_time_total']
         transcription_cost = round(total_transcription_seconds * minute_price / 60, 2)
 
         all_time_cost = token_cost + transcription_cost + image_cost
         return all_time_cost
+
+
+class UsageTrackerCache:
+    """
+    Size- and idle-time-bounded LRU cache of UsageTrackers.
+    Evicted trackers with unsaved changes or a write in progress are kept in a draining map until
+    a flush has written them, and are handed back if their user shows up again before that.
+    Trackers that are not cached are reloaded from the usage store on the next access.
+    """
+
+    def __init__(self, maxsize=1000, idle_ttl=3600):
+        """
+        :param maxsize: maximum number of trackers to keep in memory
+        :param idle_ttl: seconds after which an unused tracker is evicted, 0 to disable
+        """
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self.trackers = OrderedDict()  # {user_id: (tracker, last_access)}
+        self.draining = {}  # {user_id: tracker}, evicted trackers waiting for a flush
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        """Gets the tracker of a user and marks it as recently used.
+
+        :return: the cached UsageTracker, or None if it has to be loaded
+        """
+        self.evict_idle()
+        if user_id in self.trackers:
+            tracker = self.trackers[user_id][0]
+        elif user_id in self.draining:
+            tracker = self.draining.pop(user_id)
+        else:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.set(user_id, tracker)
+        return tracker
+
+    def set(self, user_id, tracker):
+        """Stores a tracker, evicting the least recently used trackers if the cache is full.
+        """
+        self.trackers[user_id] = (tracker, time.monotonic())
+        self.trackers.move_to_end(user_id)
+        while len(self.trackers) > self.maxsize:
+            self.__evict()
+
+    def evict_idle(self):
+        """Evicts trackers that were not used for idle_ttl seconds.
+        """
+        if not self.idle_ttl:
+            return
+        deadline = time.monotonic() - self.idle_ttl
+        # trackers are ordered by last access, so the idle ones are at the front
+        while self.trackers and next(iter(self.trackers.values()))[1] <= deadline:
+            self.__evict()
+
+    def values(self):
+        """Gets all trackers in memory, including evicted ones waiting for a flush.
+        """
+        return [tracker for tracker, _ in self.trackers.values()] + list(self.draining.values())
+
+    def drop_flushed(self):
+        """Forgets evicted trackers that have been written to the usage store.
+        """
+        self.draining = {user_id: tracker for user_id, tracker in self.draining.items()
+                         if tracker.dirty or tracker.writing}
+
+    def __evict(self):
+        user_id, (tracker, _) = self.trackers.popitem(last=False)
+        self.evictions += 1
+        if tracker.dirty or tracker.writing:
+            self.draining[user_id] = tracker
+
+    def __contains__(self, user_id):
+        return user_id in self.trackers or user_id in self.draining
+
+    def __len__(self):
+        return len(self.trackers) + len(self.draining)
@@ -1,20 +1,24 @@
 from __future__ import annotations
-from typing import Generator
-import os
+from typing import AsyncGenerator, AsyncIterable
 import asyncio
+import functools
 import itertools
 import logging
-from uuid import uuid4
-from httpx import AsyncClient
+from io import BytesIO
+import importlib.util
+from httpx import AsyncClient, Limits, Timeout
 
-from moviepy.editor import VideoFileClip, AudioFileClip
+import numpy as np
 from pydub import AudioSegment
 
 import telegram
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
+from access_policy import AccessPolicy, AccessPolicyLoader
+from cache import TTLCache
 from usage_tracker import UsageTracker
+from transcription_cache import get_transcription_cache, chunk_key
 import settings
 
 
@@ -58,18 +62,6 @@ def get_thread_id(update: Update) -> int | None:
     return None
 
 
-def get_stream_cutoff_values(update: Update, content: str) -> int:
-    """
-    Gets the stream cutoff values for the message length
-    """
-    if is_group_chat(update):
-        # group chats have stricter flood limits
-        return 180 if len(content) > 1000 else 120 if len(content) > 200 \
-            else 90 if len(content) > 50 else 50
-    return 90 if len(content) > 1000 else 45 if len(content) > 200 \
-        else 25 if len(content) > 50 else 15
-
-
 def is_group_chat(update: Update) -> bool:
     """
     Checks if the message was sent from a group chat
@@ -152,51 +144,157 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.error(f'Exception while handling an update: {context.error}')
 
 
+def get_access_policy(config) -> AccessPolicy:
+    """
+    Gets the parsed access-control and budget tables for the bot configuration.
+    """
+    if 'access_policy' not in config:
+        config['access_policy'] = AccessPolicyLoader(config)
+    return config['access_policy'].get()
+
+
+# authorized users (allowed + admins) found in each group chat: {group_chat_id: (policy, set(user_id))}
+_group_members = TTLCache(maxsize=10000)
+# groups being looked up: {group_chat_id: (policy, Task returning the members found)}
+_group_member_scans: dict[int, tuple[AccessPolicy, asyncio.Task]] = {}
+# number of authorized users looked up concurrently
+GROUP_MEMBER_LOOKUP_BATCH = 20
+# attempts per user if the Bot API asks to retry later
+GROUP_MEMBER_LOOKUP_ATTEMPTS = 3
+# seconds to cache a group without members found if some lookups failed
+GROUP_MEMBERS_FAILED_TTL = 60
+
+
+async def get_authorized_group_members(config, update: Update, context: CallbackContext) -> set[int]:
+    """
+    Gets the authorized users found in the group chat of the update.
+    Cached per group. On a cache miss the authorized users are looked up in batches until
+    a member is found, so the result is empty or contains at least one member, not all of them.
+    Concurrent messages of the same group share one lookup.
+    """
+    policy = get_access_policy(config)
+    chat_id = update.message.chat_id
+    cached = _group_members.get(chat_id)
+    # entries computed for a previous (reloaded) policy are stale
+    if cached is not None and cached[0] is policy:
+        return cached[1]
+
+    scan = _group_member_scans.get(chat_id)
+    if scan is None or scan[0] is not policy:
+        scan = (policy, asyncio.create_task(_scan_group_members(config, policy, update, context)))
+        _group_member_scans[chat_id] = scan
+
+        def _scan_done(_, current_scan=scan):
+            if _group_member_scans.get(chat_id) is current_scan:
+                del _group_member_scans[chat_id]
+
+        scan[1].add_done_callback(_scan_done)
+    return await asyncio.shield(scan[1])
+
+
+async def _scan_group_members(config, policy: AccessPolicy, update: Update, context: CallbackContext) -> set[int]:
+    """
+    Looks up the authorized users in the group chat of the update until a member is found, and caches the result.
+    Failed lookups count as not a member.
+    """
+    chat_id = update.message.chat_id
+    failed = False
+
+    async def _check(user_id) -> bool:
+        nonlocal failed
+        for attempt in range(GROUP_MEMBER_LOOKUP_ATTEMPTS):
+            try:
+                return await is_user_in_group(update, context, user_id)
+            except telegram.error.RetryAfter as e:
+                if attempt < GROUP_MEMBER_LOOKUP_ATTEMPTS - 1:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                error = e
+            except Exception as e:
+                error = e
+            logging.warning(f'Failed to check if user {user_id} is a member of group {chat_id}: {str(error)}')
+            failed = True
+            return False
+
+    members = set()
+    user_ids = list(policy.authorized_user_ids)
+    for start in range(0, len(user_ids), GROUP_MEMBER_LOOKUP_BATCH):
+        batch = user_ids[start:start + GROUP_MEMBER_LOOKUP_BATCH]
+        results = await asyncio.gather(*[_check(user_id) for user_id in batch])
+        members.update(user_id for user_id, is_member in zip(batch, results) if is_member)
+        if members:
+            break
+
+    ttl = config['group_members_cache_ttl']
+    if failed and not members:
+        # a failed lookup may have missed a member, look again soon
+        ttl = min(ttl, GROUP_MEMBERS_FAILED_TTL)
+    _group_members.set(chat_id, (policy, members), ttl=ttl)
+    return members
+
+
+def update_group_members(config, update: Update):
+    """
+    Keeps the cached authorized members of a group up to date from ChatMemberUpdated events.
+    """
+    chat_member = update.chat_member or update.my_chat_member
+    chat_id = chat_member.chat.id
+    if update.my_chat_member:
+        # the bot itself was added or removed, look the group up again next time
+        _group_members.pop(chat_id)
+        return
+
+    cached = _group_members.get(chat_id)
+    user_id = chat_member.new_chat_member.user.id
+    if cached is None or user_id not in cached[0].authorized_user_ids:
+        return
+    if chat_member.new_chat_member.status in [ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER]:
+        cached[1].add(user_id)
+    else:
+        cached[1].discard(user_id)
+        if not cached[1]:
+            # the lookup stops at the first member found, other members may still be in the group
+            _group_members.pop(chat_id)
+
+
 async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False) -> bool:
     """
     Checks if the user is allowed to use the bot.
     """
-    if config['allowed_user_ids'] == '*':
+    policy = get_access_policy(config)
+    if policy.allow_all:
         return True
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    if is_admin(config, user_id):
+    if policy.is_admin(user_id):
         return True
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    allowed_user_ids = config['allowed_user_ids'].split(',')
     # Check if user is allowed
-    if str(user_id) in allowed_user_ids:
+    if policy.is_allowed_user(user_id):
         return True
     # Check if it's a group a chat with at least one authorized member
     if not is_inline and is_group_chat(update):
-        admin_user_ids = config['admin_user_ids'].split(',')
-        for user in itertools.chain(allowed_user_ids, admin_user_ids):
-            if not user.strip():
-                continue
-            if await is_user_in_group(update, context, user):
-                logging.info(f'{user} is a member. Allowing group chat message...')
-                return True
+        members = await get_authorized_group_members(config, update, context)
+        if members:
+            logging.info(f'{next(iter(members))} is a member. Allowing group chat message...')
+            return True
         logging.info(f'Group chat messages from user {name} '
                      f'(id: {user_id}) are not allowed')
     return False
 
+
 def is_admin(config, user_id: int, log_no_admin=False) -> bool:
     """
     Checks if the user is the admin of the bot.
     The first user in the user list is the admin.
     """
-    if config['admin_user_ids'] == '-':
+    policy = get_access_policy(config)
+    if not policy.admin_user_ids:
         if log_no_admin:
             logging.info('No admin user defined.')
         return False
 
-    admin_user_ids = config['admin_user_ids'].split(',')
-
-    # Check if user is in the admin user list
-    if str(user_id) in admin_user_ids:
-        return True
-
-    return False
+    return policy.is_admin(user_id)
 
 
 def get_user_budget(config, user_id) -> float | None:
@@ -206,30 +304,33 @@ def get_user_budget(config, user_id) -> float | None:
     :param user_id: User id
     :return: The user's budget as a float, or None if the user is not found in the allowed user list
     """
+    return get_access_policy(config).get_user_budget(user_id)
 
-    # no budget restrictions for admins and '*'-budget lists
-    if is_admin(config, user_id) or config['user_budgets'] == '*':
-        return float('inf')
-
-    user_budgets = config['user_budgets'].split(',')
-    if config['allowed_user_ids'] == '*':
-        # same budget for all users, use value in first position of budget list
-        if len(user_budgets) > 1:
-            logging.warning('multiple values for budgets set with unrestricted user list '
-                            'only the first value is used as budget for everyone.')
-        return float(user_budgets[0])
-
-    allowed_user_ids = config['allowed_user_ids'].split(',')
-    if str(user_id) in allowed_user_ids:
-        user_index = allowed_user_ids.index(str(user_id))
-        if len(user_budgets) <= user_index:
-            logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
-            return 0.0
-        return float(user_budgets[user_index])
-    return None
 
-
-def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+async def load_usage_tracker(config, usage, user_id, user_name) -> UsageTracker:
+    """
+    Gets the usage tracker of a user, loading it on an executor thread on first access.
+    :param config: The bot configuration object
+    :param usage: The UsageTrackerCache
+    :param user_id: The user id (or 'guests')
+    :param user_name: The user name, used for new usage files
+    :return: The user's UsageTracker
+    """
+    tracker = usage.get(user_id)
+    if tracker is None:
+        loaded = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            UsageTracker, user_id, user_name, store=config.get('usage_store'),
+            write_behind=config['usage_flush_interval'] > 0
+        ))
+        # another request may have loaded the tracker in the meantime
+        tracker = usage.get(user_id) if user_id in usage else None
+        if tracker is None:
+            tracker = loaded
+            usage.set(user_id, tracker)
+    return tracker
+
+
+async def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
     """
     Calculate the remaining budget for a user based on their current usage.
     :param config: The bot configuration object
@@ -247,24 +348,22 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    user_tracker = await load_usage_tracker(config, usage, user_id, name)
 
     # Get budget for users
     user_budget = get_user_budget(config, user_id)
     budget_period = config['budget_period']
     if user_budget is not None:
-        cost = usage[user_id].get_current_cost()[budget_cost_map[budget_period]]
+        cost = user_tracker.get_current_cost()[budget_cost_map[budget_period]]
         return user_budget - cost
 
     # Get budget for guests
-    if 'guests' not in usage:
-        usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
-    cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
+    guest_tracker = await load_usage_tracker(config, usage, 'guests', 'all guest users in group chats')
+    cost = guest_tracker.get_current_cost()[budget_cost_map[budget_period]]
     return config['guest_budget'] - cost
 
 
-def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
+async def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     """
     Checks if the user reached their usage limit.
     Initializes UsageTracker for user and guest when needed.
@@ -274,29 +373,27 @@ def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     :param is_inline: Boolean flag for inline queries
     :return: Boolean indicating if the user has a positive budget
     """
-    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
-    remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
+    remaining_budget = await get_remaining_budget(config, usage, update, is_inline=is_inline)
     return remaining_budget > 0
 
 
-def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
+async def add_chat_request_to_usage_tracker(usage, config, user_id, user_name, used_tokens):
     """
     Add chat request to usage tracker
     :param usage: The usage tracker object
     :param config: The bot configuration object
     :param user_id: The user id
+    :param user_name: The user name, used for new usage files
     :param used_tokens: The number of tokens used
     """
     try:
         # add chat request to users usage tracker
-        usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
+        user_tracker = await load_usage_tracker(config, usage, user_id, user_name)
+        user_tracker.add_chat_tokens(used_tokens, config['token_price'])
         # add guest chat request to guest usage tracker
-        allowed_user_ids = config['allowed_user_ids'].split(',')
-        if str(user_id) not in allowed_user_ids and 'guests' in usage:
-            usage["guests"].add_chat_tokens(used_tokens, config['token_price'])
+        if not get_access_policy(config).is_allowed_user(user_id):
+            guest_tracker = await load_usage_tracker(config, usage, 'guests', 'all guest users in group chats')
+            guest_tracker.add_chat_tokens(used_tokens, config['token_price'])
     except Exception as e:
         logging.warning(f'Failed to add tokens to usage_logs: {str(e)}')
         pass
@@ -314,69 +411,276 @@ def get_reply_to_message_id(config, update: Update):
     return None
 
 
-def extract_audio_from_video(file_path: str) -> AudioFileClip:
-    video = VideoFileClip(file_path)
-    return video.audio
+_http_client: AsyncClient | None = None
+
+
+def get_http_client() -> AsyncClient:
+    """
+    Общий для всего процесса HTTP клиент с пулом keep-alive соединений (и HTTP/2, если установлен h2).
+    Создается в ChatGPTTelegramBot.post_init и закрывается в post_shutdown.
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = AsyncClient(
+            http2=importlib.util.find_spec('h2') is not None,
+            limits=Limits(max_connections=settings.HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS),
+            timeout=Timeout(settings.HTTP_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+# форматы сырого PCM в ffmpeg по ширине сэмпла в байтах
+PCM_FORMATS = {1: 'u8', 2: 's16le', 4: 's32le'}
+
+_whisper_semaphore: asyncio.Semaphore | None = None
+
+
+def get_whisper_semaphore() -> asyncio.Semaphore:
+    """
+    Общий для всего бота лимит одновременных запросов к Whisper.
+    Создается лениво, чтобы привязаться к работающему event loop.
+    """
+    global _whisper_semaphore
+    if _whisper_semaphore is None:
+        _whisper_semaphore = asyncio.Semaphore(settings.WHISPER_MAX_CONCURRENT_REQUESTS)
+    return _whisper_semaphore
+
+
+def get_retry_after(response, default: float = 20.0) -> float:
+    """
+    Сколько секунд ждать после ответа 429 (заголовок Retry-After, если он есть).
+    """
+    try:
+        return float(response.headers.get('retry-after', default))
+    except ValueError:
+        return default
 
 
 async def transcribe(file_buffer):
     whisper_url = 'https://api.openai.com/v1/audio/transcriptions'
-    async with AsyncClient(timeout=None) as client:
-        headers = {'Authorization': f'Bearer {settings.OPENAI_API_KEY}'}
-        payload = {
-            'model': (None, 'whisper-1'),
-            'file': ('file.mp3', file_buffer)
-        }
-        response = await client.post(url=whisper_url, files=payload, headers=headers)
-        if response.status_code == 200:
-            return response.json()['text']
-        return response.json()
+    headers = {'Authorization': f'Bearer {settings.OPENAI_API_KEY}'}
+    async with get_whisper_semaphore():
+        for attempt in range(settings.WHISPER_MAX_RETRIES + 1):
+            file_buffer.seek(0)
+            payload = {
+                'model': (None, 'whisper-1'),
+                'file': ('file.mp3', file_buffer)
+            }
+            response = await get_http_client().post(url=whisper_url, files=payload, headers=headers)
+            if response.status_code == 429 and attempt < settings.WHISPER_MAX_RETRIES:
+                retry_after = get_retry_after(response)
+                logging.warning(f'Whisper rate limit reached, retrying in {retry_after}s')
+                await asyncio.sleep(retry_after)
+                continue
+            break
+    if response.status_code == 200:
+        return response.json()['text']
+    return response.json()
 
 
-async def streaming_transcribe(audio: AudioSegment, update: Update):
+async def encode_mp3(chunk: AudioSegment) -> bytes:
     """
-    делает транскрибацию аудио сегмента и отправляет ее стримингом пользователю.
+    кодирует кусок аудио в mp3 через ffmpeg без временных файлов:
+    сырой PCM пишется в stdin процесса, mp3 читается из его stdout.
     """
-    text = ''
-    message = None
-    for chunk in chop_audio(audio, 120):
-        chunk_name = f'/app/bot/file/{uuid4()}.mp3'
-        chunk.export(chunk_name, format='mp3')
-        with open(chunk_name, 'rb') as f:
-            t = await transcribe(f)
-            os.remove(chunk_name)
-        if len(text + t) < 4096:
-            message = await stream_text(text=t, last_text=text, update=update, message=message)
-            text += t
-        else:
-            message = await stream_text(text=t, update=update)
-            text = ''
-    return message
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-loglevel', 'error',
+        '-f', PCM_FORMATS[chunk.sample_width], '-ar', str(chunk.frame_rate), '-ac', str(chunk.channels), '-i', 'pipe:0',
+        '-f', 'mp3', 'pipe:1',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    mp3, _ = await process.communicate(chunk.raw_data)
+    if process.returncode != 0:
+        raise Exception(f'ffmpeg exited with code {process.returncode} while encoding mp3')
+    return mp3
 
 
-def chop_audio(audio: AudioSegment, chunk_duration: int) -> Generator:
+async def transcribe_chunk(chunk: AudioSegment) -> str:
     """
-    :param audio: Audiosegment
-    :param chunk_duration: chunk duration in seconds
-    add bytes in input
+    кодирует кусок аудио в mp3 прямо в памяти и отправляет его в Whisper.
+    Одинаковые куски берутся из кэша транскрипций без запроса к Whisper.
     """
+    cache = get_transcription_cache()
+    key = chunk_key(chunk.raw_data) if cache is not None else None
+    if cache is not None:
+        cached = await cache.get(key)
+        if cached is not None:
+            return cached
 
-    start_time = 0
-    end_time = chunk_duration * 1000
+    text = await transcribe(BytesIO(await encode_mp3(chunk)))
+    if cache is not None and isinstance(text, str):
+        await cache.set(key, text)
+    return text
 
-    while True:
-        if start_time >= audio.duration_seconds * 1000:
-            break
 
-        yield audio[start_time:end_time]
+async def streaming_transcribe(chunks: AsyncIterable[AudioSegment], update: Update):
+    """
+    делает транскрибацию кусков аудио и отправляет ее стримингом пользователю.
+    Отдельная задача читает куски и держит в работе settings.TRANSCRIPTION_CONCURRENCY транскрибаций
+    независимо от того, как быстро текст показывается пользователю, а текст отправляется
+    строго по порядку кусков.
+    :param chunks: куски из stream_chop_audio
+    :return: полный текст транскрипции и признак того, что все куски транскрибированы без ошибок
+    """
+    text = ''
+    transcript = []
+    complete = True
+    message = None
+    # задачи в порядке кусков. В конце кладется None, а если чтение кусков упало - исключение
+    queue: asyncio.Queue = asyncio.Queue()
+    # слот занят, пока кусок транскрибируется: в работе всегда до TRANSCRIPTION_CONCURRENCY кусков,
+    # как бы медленно ни показывался текст. Готовые транскрипты ждут показа в очереди, аудио уже не держится
+    slots = asyncio.Semaphore(max(settings.TRANSCRIPTION_CONCURRENCY, 1))
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                await slots.acquire()
+                task = asyncio.create_task(transcribe_chunk(chunk))
+                task.add_done_callback(lambda _: slots.release())
+                queue.put_nowait(task)
+        except Exception as e:
+            queue.put_nowait(e)
+        else:
+            queue.put_nowait(None)
 
-        start_time = end_time
-        end_time += chunk_duration * 1000
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            task = await queue.get()
+            if task is None:
+                break
+            if isinstance(task, Exception):
+                raise task
+            t = await task
+            if not isinstance(t, str):
+                # Whisper вернул ошибку: кусок пропускаем, но транскрипт уже неполный
+                logging.warning(f'Failed to transcribe a chunk: {t}')
+                complete = False
+                continue
+            transcript.append(t)
+            if len(text + t) < 4096:
+                message = await stream_text(text=t, last_text=text, update=update, message=message)
+                text += t
+            else:
+                message = await stream_text(text=t, update=update)
+                text = ''
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        while not queue.empty():
+            task = queue.get_nowait()
+            if isinstance(task, asyncio.Task):
+                task.cancel()
+        if hasattr(chunks, 'aclose'):
+            # останавливаем ffmpeg, если транскрибация прервалась на середине
+            await chunks.aclose()
+    return ' '.join(transcript), complete
+
+
+def find_silence_boundary(samples: np.ndarray, frame_rate: int, start: int, end: int, window_ms: int = 50) -> int:
+    """
+    ищет самое тихое место в samples[start:end]: считает RMS по окнам window_ms
+    одним векторным проходом и возвращает индекс сэмпла в середине самого тихого окна.
+    :param samples: моно сэмплы
+    :param frame_rate: частота дискретизации
+    """
+    window = max(frame_rate * window_ms // 1000, 1)
+    region = samples[start:end].astype(np.float32)
+    windows_count = len(region) // window
+    if windows_count == 0:
+        return end
+    frames = region[:windows_count * window].reshape(windows_count, window)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return start + int(np.argmin(rms)) * window + window // 2
+
+
+def get_split_point(samples: np.ndarray, frame_rate: int, chunk_duration: int, silence_tolerance: int = 0) -> int:
+    """
+    возвращает индекс сэмпла, по которому отрезать следующий кусок.
+    Без silence_tolerance режет ровно по chunk_duration, иначе ищет тишину
+    в окне chunk_duration ± silence_tolerance секунд. Кусок никогда не длиннее
+    chunk_duration + silence_tolerance, чтобы не упереться в лимит размера файла Whisper (25 МБ).
+    """
+    target = chunk_duration * frame_rate
+    if len(samples) <= target:
+        return len(samples)
+    if silence_tolerance <= 0:
+        return target
+    tolerance = silence_tolerance * frame_rate
+    return find_silence_boundary(samples, frame_rate, target - tolerance, min(target + tolerance, len(samples)))
+
+
+async def stream_chop_audio(source: str, chunk_duration: int, silence_tolerance: int = 0) -> AsyncGenerator:
+    """
+    режет аудио на куски для Whisper без загрузки всей записи в память:
+    ffmpeg декодирует источник в сырой PCM в stdout, а куски читаются из пайпа по мере надобности.
+    Пока куски не забирают, ffmpeg блокируется на записи в пайп, так что память на задачу не растет
+    с длиной записи.
+    :param source: путь к файлу (или url), который понимает ffmpeg
+    :param chunk_duration: chunk duration in seconds
+    :param silence_tolerance: на сколько секунд можно сдвинуть границу куска, чтобы попасть в тишину
+    """
+    frame_rate = settings.STREAM_DECODE_FRAME_RATE
+    # читаем с запасом, чтобы было где искать тишину за chunk_duration
+    max_chunk_size = (chunk_duration + max(silence_tolerance, 0)) * frame_rate * 2  # s16le, моно
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-nostdin', '-loglevel', 'error', '-i', source,
+        '-vn', '-ac', '1', '-ar', str(frame_rate), '-f', 's16le', 'pipe:1',
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    buffer = b''
+    finished = False
+    try:
+        while not finished or buffer:
+            if not finished:
+                try:
+                    buffer += await process.stdout.readexactly(max_chunk_size - len(buffer))
+                except asyncio.IncompleteReadError as e:
+                    buffer += e.partial
+                    finished = True
+            if not buffer:
+                break
+            samples = np.frombuffer(buffer, dtype=np.int16)
+            if finished and len(buffer) <= max_chunk_size:
+                split_point = len(samples)
+            else:
+                split_point = get_split_point(samples, frame_rate, chunk_duration, silence_tolerance)
+            yield AudioSegment(data=buffer[:split_point * 2], sample_width=2, frame_rate=frame_rate, channels=1)
+            buffer = buffer[split_point * 2:]
+    except BaseException:
+        # генератор закрыли раньше времени (aclose, отмена задачи или ошибка): ffmpeg больше не нужен
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+        raise
+    # stdout дочитан до конца, ждем, пока ffmpeg завершится сам
+    await process.wait()
+    if process.returncode != 0:
+        raise Exception(f'ffmpeg exited with code {process.returncode} while decoding {source}')
+
+
+async def send_transcript(update: Update, transcript: str):
+    """
+    отправляет готовый транскрипт (например, из кэша) целиком, без стриминга.
+    """
+    for chunk in split_into_chunks(transcript):
+        await update.effective_message.reply_text(chunk)
 
 
 async def get_file(file_id):
-    async with AsyncClient(timeout=None) as client:
-        return await client.get(f'http://0.0.0.0:8081/bot{settings.TELEGRAM_KEY}/getFile?file_id={file_id}')
+    return await get_http_client().get(f'http://0.0.0.0:8081/bot{settings.TELEGRAM_KEY}/getFile?file_id={file_id}')
 
 
 async def stream_text(text,
@@ -401,34 +705,63 @@ async def stream_text(text,
     return message
 
 
+# результаты проверок подписки: {(user_id, channel): bool}
+_subscription_cache = TTLCache(maxsize=settings.SUBSCRIPTION_CACHE_SIZE)
+# запросы get_chat_member, которые уже выполняются: {(user_id, channel): Task}
+_subscription_requests: dict[tuple, asyncio.Task] = {}
+# update_id апдейтов, которые уже прошли проверку подписки
+_subscribed_updates = TTLCache(maxsize=1024, ttl=600)
+
+
 def is_subscribed_decorator(func):
-    async def wrapper(*args):
-        if len(args) == 3:
-            self = args[0]
-            update = args[1]
-            context = args[2]
-        else:
-            update = args[0]
-            context = args[1]
-        for channel in settings.CHANNELS:
+    """
+    Пускает в обработчик только подписчиков всех каналов из settings.CHANNELS.
+    Проверка делается один раз на апдейт, даже если декорированные методы вызывают друг друга.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        update = next(arg for arg in itertools.chain(args, kwargs.values()) if isinstance(arg, Update))
+        if update.update_id in _subscribed_updates:
+            return await func(*args, **kwargs)
 
+        for channel in settings.CHANNELS:
             result = await is_subscribed(update.effective_user.id,
                                          channel,
-                                         context)
+                                         update.get_bot())
             if not result:
                 await update.effective_message.reply_text(f'Подпишитесь на канал {channel}, чтобы пользоваться ботом')
                 return
-        result = await func(*args)
+        _subscribed_updates.set(update.update_id, True)
+        result = await func(*args, **kwargs)
         return result
 
     return wrapper
 
 
-async def is_subscribed(user_id, chat_id, context: ContextTypes.DEFAULT_TYPE):
+async def is_subscribed(user_id, chat_id, bot: telegram.Bot) -> bool:
+    """
+    Проверяет подписку пользователя на канал. Результат кэшируется
+    (отдельные TTL для подписчиков и неподписчиков), а одновременные проверки
+    одной и той же пары объединяются в один запрос к Bot API.
+    """
+    key = (user_id, chat_id)
+    cached = _subscription_cache.get(key)
+    if cached is not None:
+        return cached
+
+    task = _subscription_requests.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch_subscription(user_id, chat_id, bot))
+        _subscription_requests[key] = task
+        task.add_done_callback(lambda _: _subscription_requests.pop(key, None))
+    return await asyncio.shield(task)
+
 
-    result = await context.bot.get_chat_member(chat_id, user_id)
+async def fetch_subscription(user_id, chat_id, bot: telegram.Bot) -> bool:
+    result = await bot.get_chat_member(chat_id, user_id)
     status = result.status
-    if status == ChatMember.LEFT or\
-            status == ChatMember.BANNED or status == ChatMember.RESTRICTED:
-        return False
-    return True
+    subscribed = not (status == ChatMember.LEFT or
+                      status == ChatMember.BANNED or status == ChatMember.RESTRICTED)
+    ttl = settings.SUBSCRIPTION_CACHE_TTL if subscribed else settings.SUBSCRIPTION_NEGATIVE_CACHE_TTL
+    _subscription_cache.set((user_id, chat_id), subscribed, ttl=ttl)
+    return subscribed